@@ -34,16 +34,16 @@ def chi1d(h,energies = [0.],t=0.0001,delta=0.01,q=0.001,nk=1000,U=None,adaptive=
     ms = [m[i,:].reshape(n,n) for i in range(len(m))] # convert to matrices
   if adaptive: # adaptive algorithm 
     from integration import integrate_matrix
-    def get_chik(k): # function which returns a matrix
-      """ Get response at a cetain energy"""
-      hk = hkgen(k) # first point
-      e1,ev1 = lg.eigh(hk) # get eigenvalues
-      hk = hkgen(k+q) # second point
-      e2,ev2 = lg.eigh(hk) # get eigenvalues
-      ct = calculate_xychi(ev1.T,e1,ev2.T,e2,energies,t,delta) # contribution
-      return ct # return response
+    def get_chiks(ks): # function which returns a list of matrices
+      """ Get response for several k-points at once"""
+      hs = [hkgen(k) for k in ks] + [hkgen(k+q) for k in ks] # all points
+      es,evs = lg.eigh(np.array(hs)) # diagonalize all of them together
+      nk = len(ks) # number of kpoints
+      return [calculate_xychi(evs[i].T,es[i],evs[i+nk].T,es[i+nk],
+                   energies,t,delta) for i in range(nk)] # contributions
     ms = []
-    m = integrate_matrix(get_chik,xlim=[0.,1.],eps=.1,only_imag=False) # add energy
+    m = integrate_matrix(None,xlim=[0.,1.],eps=.1,only_imag=False,
+                           fbatch=get_chiks) # add energy
     ms = [m[i,:].reshape(n,n) for i in range(len(m))] # convert to matrices
 
   if U==None: # raw calculation
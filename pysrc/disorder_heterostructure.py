@@ -3,17 +3,17 @@
 import numpy as np
 import random
 
-def anderson(hetero,w=0.2,write=False):
+def anderson(hetero,w=0.2,write=False,rng=random):
   """Adds anderson disorder, asumes spinpol calculation"""
   hc = hetero.central_intra # this is a nxn tridiagonal list of matrices
   nb = len(hc)  # number of blocks
   norb = len(hc[0][0]) # number of orbitals with spin degree of freedom
   if hetero.has_spin:
-    norb = norb/2 # without spin degree
+    norb = norb//2 # without spin degree
   if write: fa = open("ANDERSON_DISORDER.OUT","w")
   for ib in range(nb): # loop over blocks
     for iorb in range(norb): # loop over orbitals
-      wi = (random.random()-0.5)*w  # stregth of the disorder
+      wi = (rng.random()-0.5)*w  # stregth of the disorder
       if hetero.has_spin:
         hc[ib][ib][2*iorb,2*iorb] += wi  # up channel
         hc[ib][ib][2*iorb+1,2*iorb+1] += wi  # same for down channel
@@ -24,79 +24,159 @@ def anderson(hetero,w=0.2,write=False):
   if write: fa.close()  # close file
 
 
-def magnetic_z(hetero,w=0.2):
+def magnetic_z(hetero,w=0.2,write=True,rng=random):
   """Adds off-plane magnetic disorder, asumes spinpol calculation"""
   hc = hetero.central_intra # this is a nxn tridiagonal list of matrices
   nb = len(hc)  # number of blocks
   norb = len(hc[0][0]) # number of orbitals with spin degree of freedom
-  norb = norb/2 # without spin degree
-  fa = open("MZ_DISORDER.OUT","w")
+  norb = norb//2 # without spin degree
+  if write: fa = open("MZ_DISORDER.OUT","w")
   for ib in range(nb): # loop over blocks
     for iorb in range(norb): # loop over orbitals
-      wi = (random.random()-0.5)*w  # stregth of the disorder
+      wi = (rng.random()-0.5)*w  # stregth of the disorder
       hc[ib][ib][2*iorb,2*iorb] += wi
       hc[ib][ib][2*iorb+1,2*iorb+1] += -wi
-      fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
-  fa.close()
+      if write: # write in file
+        fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
+  if write: fa.close()
 
 
 
-def magnetic_x(hetero,w=0.2):
+def magnetic_x(hetero,w=0.2,write=True,rng=random):
   """Adds in-plane magnetic disorder, asumes spinpol calculation"""
   hc = hetero.central_intra # this is a nxn tridiagonal list of matrices
   nb = len(hc)  # number of blocks
   norb = len(hc[0][0]) # number of orbitals with spin degree of freedom
-  norb = norb/2 # without spin degree
-  fa = open("MX_DISORDER.OUT","w")
+  norb = norb//2 # without spin degree
+  if write: fa = open("MX_DISORDER.OUT","w")
   for ib in range(nb): # loop over blocks
     for iorb in range(norb): # loop over orbitals
-      wi = (random.random()-0.5)*w  # stregth of the disorder
+      wi = (rng.random()-0.5)*w  # stregth of the disorder
       hc[ib][ib][2*iorb,2*iorb+1] += wi
       hc[ib][ib][2*iorb+1,2*iorb] += wi
-      fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
-  fa.close()
+      if write: # write in file
+        fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
+  if write: fa.close()
 
 
-def magnetic_y(hetero,w=0.2):
+def magnetic_y(hetero,w=0.2,write=True,rng=random):
   """Adds in-plane magnetic disorder, asumes spinpol calculation"""
   hc = hetero.central_intra # this is a nxn tridiagonal list of matrices
   nb = len(hc)  # number of blocks
   norb = len(hc[0][0]) # number of orbitals with spin degree of freedom
-  norb = norb/2 # without spin degree
-  fa = open("MY_DISORDER.OUT","w")
+  norb = norb//2 # without spin degree
+  if write: fa = open("MY_DISORDER.OUT","w")
   for ib in range(nb): # loop over blocks
     for iorb in range(norb): # loop over orbitals
-      wi = (random.random()-0.5)*w  # stregth of the disorder
+      wi = (rng.random()-0.5)*w  # stregth of the disorder
       hc[ib][ib][2*iorb,2*iorb+1] += 1j*wi
       hc[ib][ib][2*iorb+1,2*iorb] += -1j*wi
-      fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
-  fa.close()
+      if write: # write in file
+        fa.write(str(ib)+"   "+str(iorb)+"   "+str(wi)+"\n") # save the quantity
+  if write: fa.close()
 
 
 
 
 
 
-def random_vacancies(hetero,w=300.0,p_vac=0.0):
+def random_vacancies(hetero,w=300.0,p_vac=0.0,write=True,rng=random):
   """Adds a random vacancy, asumes spinpol calculation"""
   hc = hetero.central_intra # this is a nxn tridiagonal list of matrices
   nb = len(hc)  # number of blocks
   norb = len(hc[0][0]) # number of orbitals with spin degree of freedom
-  fa = open("VACANCY_DISORDER.OUT","w")
-  norb = norb/2 # without spin degree
+  if write: fa = open("VACANCY_DISORDER.OUT","w")
+  norb = norb//2 # without spin degree
   ind_vac_tot = []  # indexes of the vacancies
   for ib in range(nb): # loop over blocks
     ind_vac = []  # indexes of the vacancies
     for iorb in range(norb): # loop over orbitals
-      r = random.random() # random number
+      r = rng.random() # random number
       if r<p_vac: # if not chosen yet, add and exit while
         ind_vac.append(iorb)
     ind_vac_tot.append(ind_vac)
     for iorb in ind_vac:
       hc[ib][ib][2*iorb,2*iorb] += w
       hc[ib][ib][2*iorb+1,2*iorb+1] += w
-      fa.write(str(ib)+"   "+str(iorb)+"   "+str(1.0)+"\n") # save the quantity
-  fa.close()
-
-
+      if write: # write in file
+        fa.write(str(ib)+"   "+str(iorb)+"   "+str(1.0)+"\n") # save the quantity
+  if write: fa.close()
+
+
+
+
+
+
+
+
+class conductance_statistics():
+  """Streaming mean, variance and histogram of the conductance
+  for a list of energies, without storing the realizations"""
+  def __init__(self,ne,bins):
+    self.n = 0 # number of realizations
+    self.bins = np.array(bins) # edges of the histogram
+    self.mean = np.zeros(ne) # mean value
+    self.m2 = np.zeros(ne) # sum of squared deviations
+    self.histogram = np.zeros((ne,len(bins)-1),dtype=int) # counts
+  def add(self,g):
+    """Add a realization, using Welford's algorithm"""
+    g = np.array(g) # conductance at each energy
+    self.n += 1
+    d = g - self.mean
+    self.mean += d/self.n
+    self.m2 += d*(g - self.mean)
+    ib = np.searchsorted(self.bins,g,side="right") - 1 # bin of each energy
+    ib[g==self.bins[-1]] = len(self.bins) - 2 # last edge in the last bin
+    for (i,j) in enumerate(ib): 
+      if 0<=j<self.histogram.shape[1]: self.histogram[i,j] += 1
+  def merge(self,s):
+    """Merge the statistics of another set of realizations"""
+    if s.n==0: return
+    n = self.n + s.n # total number
+    d = s.mean - self.mean
+    self.m2 += s.m2 + d*d*self.n*s.n/n
+    self.mean += d*s.n/n
+    self.n = n
+    self.histogram += s.histogram
+  def variance(self):
+    """Return the variance of the conductance"""
+    if self.n<2: return self.m2*0.
+    return self.m2/(self.n-1)
+
+
+
+def ensemble(hetero,disorder=anderson,n=100,energies=[0.0],seed=0,
+               bins=None,delta=None,cores=None,**kwargs):
+  """Conductance statistics over n disorder realizations. disorder is a
+  function modifying the central part, such as anderson, called with a
+  random generator seeded for each realization and the rest of the
+  keyword arguments. The lead selfenergies are computed once and shared
+  by all the realizations. Returns a conductance_statistics object"""
+  import parallel
+  from copy import copy
+  import heterostructures
+  if not hetero.block_diagonal: raise # disorder functions work with blocks
+  if delta is None: delta = hetero.delta
+  energies = np.array(energies).reshape(-1) # list of energies
+  if bins is None: # up to the number of channels in the leads
+    bins = np.linspace(0.,hetero.left_intra.shape[0],101)
+  # selfenergies of the leads, independent of the disorder
+  selfls = hetero.get_selfenergy_multienergy(energies,lead=0,delta=delta)
+  selfrs = hetero.get_selfenergy_multienergy(energies,lead=1,delta=delta)
+  def fun(ht,seeds): # compute a chunk of realizations
+    stats = conductance_statistics(len(energies),bins) # statistics
+    for i in seeds: # loop over realizations
+      ho = copy(ht) # shallow copy, leads are shared
+      ho.central_intra = [[None if b is None else b.copy() for b in row] 
+                             for row in ht.central_intra] # copy the center
+      rng = random.Random(str(seed)+"-"+str(i)) # reproducible generator
+      disorder(ho,rng=rng,write=False,**kwargs) # add disorder
+      g = [heterostructures.landauer(ho,energy=e,delta=delta,
+             selfl=sl,selfr=sr) for (e,sl,sr) in zip(energies,selfls,selfrs)]
+      stats.add(g) # add to the statistics
+    return [stats]
+  stats = conductance_statistics(len(energies),bins) # total statistics
+  for s in parallel.sweep_chunks(fun,hetero,range(n),cores=cores):
+    stats.merge(s) # merge as the chunks arrive
+  return stats
 
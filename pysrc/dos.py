@@ -60,17 +60,37 @@ def dos0d(h,es=None,delta=0.01):
 
 
 
-def dos0d_kpm(h,use_kpm=True,scale=10,npol=100,ntries=100,fun=None):
-  """ Calculate density of states of a 1d system"""
+def dos0d_kpm(h,use_kpm=True,scale="auto",npol=100,ntries=100,fun=None,
+                 moments_file=None):
+  """ Calculate density of states of a 1d system, the moments are
+  also saved if moments_file is provided. Returns the moments, that
+  hold the scale and shift used"""
   if h.dimensionality!=0: raise # only for 0d
   if not use_kpm: raise # only using KPM
   h.turn_sparse() # turn the hamiltonian sparse
   mus = np.array([0.0j for i in range(2*npol)]) # initialize polynomials
   import kpm
-  mus = kpm.random_trace(h.intra/scale,ntries=ntries,n=npol,fun=fun)
+  (m,scale,shift) = kpm.rescale(h.intra,scale=scale) # spectral bounds
+  mus = kpm.random_trace(m,ntries=ntries,n=npol,fun=fun)
+  mo = kpm.kpm_moments(mus=mus,scale=scale,shift=shift,ntries=ntries,
+           fingerprint=kpm.fingerprint(h.intra)) # moments and bounds
+  if moments_file is not None: mo.save(moments_file) # save the moments
   xs = np.linspace(-0.9,0.9,4*npol) # x points
   ys = kpm.generate_profile(mus,xs) # generate the profile
-  write_dos(xs*scale,ys) # write in file
+  write_dos(xs*scale+shift,ys) # write in file
+  return mo
+
+
+
+def dos_moments(input_files=["KPM_MOMENTS.npz"],ne=500,kernel="jackson",
+                  npol=None,ewindow=None,output_file="DOS.OUT"):
+  """Write the DOS from stored KPM moments, merging the moments of
+  all the files"""
+  import kpm
+  mo = kpm.merge_moments([kpm.load_moments(f) for f in input_files])
+  (xs,ys) = mo.dos(ne=ne,kernel=kernel,npol=npol,ewindow=ewindow)
+  write_dos(xs,ys,output_file=output_file) # write in file
+  return (xs,ys)
 
 
 def dos0d_sites(h,sites=[0],scale=10.,npol=500,ewindow=None,refine_e=1.0):
@@ -80,8 +100,7 @@ def dos0d_sites(h,sites=[0],scale=10.,npol=500,ewindow=None,refine_e=1.0):
   mus = np.array([0.0j for i in range(2*npol)]) # initialize polynomials
   import kpm
   hk = h.intra # hamiltonian
-  for isite in sites:
-    mus += kpm.local_dos(hk/scale,i=isite,n=npol)
+  mus += np.sum(kpm.local_dos_sites(hk/scale,sites=sites,n=npol),axis=0)
   if ewindow is None:  xs = np.linspace(-0.9,0.9,int(npol*refine_e)) # x points
   else:  xs = np.linspace(-ewindow/scale,ewindow/scale,npol) # x points
   ys = kpm.generate_profile(mus,xs) # generate the profile
@@ -108,7 +127,7 @@ def write_dos(es,ds,output_file="DOS.OUT"):
 
 
 
-def dos1d(h,use_kpm=False,scale=10.,nk=100,npol=100,ntries=2,
+def dos1d(h,use_kpm=False,scale="auto",nk=100,npol=100,ntries=2,
           ndos=1000,delta=0.01,ewindow=None,frand=None):
   """ Calculate density of states of a 1d system"""
   if h.dimensionality!=1: raise # only for 1d
@@ -123,11 +142,13 @@ def dos1d(h,use_kpm=False,scale=10.,nk=100,npol=100,ntries=2,
     yt = np.zeros(ndos) # number of dos
     import kpm
     ts = timing.Testimator("DOS") 
+    ks = [np.random.random(3) for i in range(nk)] # random k-points
+    # same bounds for all the kpoints
+    (scale,shift) = kpm.get_scale_kpoints(hkgen,ks,1,scale=scale)
     for i in range(nk): # loop over kpoints
-      k = np.random.random(3) # random k-point
-      hk = hkgen(k) # hamiltonian
+      hk = hkgen(ks[i]) # hamiltonian
       (xs,yi) = kpm.tdos(hk,scale=scale,npol=npol,frand=frand,ewindow=ewindow,
-                  ntries=ntries,ne=ndos)
+                  ntries=ntries,ne=ndos,shift=shift)
       yt += yi # Add contribution
       ts.remaining(i,nk)
     yt /= nk # normalize
@@ -148,8 +169,7 @@ def dos1d_sites(h,sites=[0],scale=10.,nk=100,npol=100,info=False,ewindow=None):
   import kpm
   for k in ks: # loop over kpoints
     hk = hkgen(k) # hamiltonian
-    for isite in sites:
-      mus += kpm.local_dos(hk/scale,i=isite,n=npol)
+    mus += np.sum(kpm.local_dos_sites(hk/scale,sites=sites,n=npol),axis=0)
     if info: print("Done",k)
   mus /= nk # normalize by the number of kpoints
   if ewindow is None:  xs = np.linspace(-0.9,0.9,npol) # x points
@@ -192,7 +212,7 @@ def calculate_dos_hkgen(hkgen,ks,ndos=100,delta=None,
 
 
 
-def dos2d(h,use_kpm=False,scale=10.,nk=100,ntries=1,delta=None,
+def dos2d(h,use_kpm=False,scale="auto",nk=100,ntries=1,delta=None,
           ndos=500,numw=20,random=True,kpm_window=1.0):
   """ Calculate density of states of a 2d system"""
   if h.dimensionality!=2: raise # only for 2d
@@ -216,20 +236,19 @@ def dos2d(h,use_kpm=False,scale=10.,nk=100,ntries=1,delta=None,
     import kpm
     tr = timing.Testimator("DOS")
     ik = 0
+    # same bounds for all the kpoints
+    (scale,shift) = kpm.get_scale_kpoints(hkgen,ks,2,scale=scale)
     for k in ks: # loop over kpoints
 #      print("KPM DOS at k-point",k)
       ik += 1
       tr.remaining(ik,len(ks))      
-      if random: 
-        kr = np.random.random(2)
-        print("Random sampling in DOS")
-        hk = hkgen(kr) # hamiltonian
-      else: hk = hkgen(k) # hamiltonian
-      mus += kpm.random_trace(hk/scale,ntries=ntries,n=npol)
+      hk = hkgen(k) # hamiltonian
+      mus += kpm.random_trace(kpm.rescale(hk,scale,shift)[0],
+                                ntries=ntries,n=npol)
     mus /= len(ks) # normalize by the number of kpoints
     xs = np.linspace(-0.9,0.9,ndos)*kpm_window # x points
     ys = kpm.generate_profile(mus,xs) # generate the profile
-    write_dos(xs*scale,ys) # write in file
+    write_dos(xs*scale+shift,ys) # write in file
     return (xs,ys)
 
 
@@ -8,13 +8,20 @@ import numpy as np
 def dos_impurity(h,vc=None,energies=np.linspace(-.5,.5,20),
                    mode="adaptive",delta=0.01,nk=50,silent=True,
                    use_generator=False):
-  """ Calculates the green function using the embedding technique"""
+  """ Calculates the green function using the embedding technique.
+  With use_generator the Green function of the crystal is broadened
+  with 2/nk instead of delta"""
   if vc is None: vc = h.intra  # assume perfect
   ds,dsv = [],[] # empty lists
   iden = np.matrix(np.identity(h.intra.shape[0],dtype=np.complex))
-  if use_generator:
-    getgreen = green.green_generator(h,nk=nk) # get the function
-    def get_green(energy): return getgreen(energy,delta=delta)
+  if use_generator or mode=="full": # diagonalize once for all energies
+    if use_generator: dg = 2./nk # same broadening as green_generator
+    else: dg = delta # broadening of the Green function
+    sg = green.spectral_green(h,nk=nk) # spectral Green function
+    gs = sg.green_multienergy(energies,delta=dg) # all the energies
+    gs = dict([(e,np.matrix(g)) for (e,g) in zip(energies,gs)])
+    def get_green(energy): 
+      return gs[energy],sg.selfenergy(gs[energy],energy,delta=dg)
   else: # use the conventional method
     def get_green(energy):
       return green.bloch_selfenergy(h,energy=energy,delta=delta,nk=nk,
@@ -390,6 +390,238 @@ def green_renormalization(intra,inter,energy=0.0,nite=None,
 
 
 
+def green_renormalization_multienergy(intra,inter,energies=[0.0],
+                            delta=0.001,nite=None,info=False,nbatch=64):
+  """ Calculates bulk and surface Green function for several energies at
+  once, using the same renormalization algorithm as green_renormalization
+  on a stack of matrices. Each energy stops iterating once it has
+  converged. The energies are processed in chunks of nbatch, to bound
+  the memory. Returns two arrays with shape (len(energies),n,n)"""
+  error = delta/100 # same criteria as for a single energy
+  try: # convert to dense matrices
+    intra = intra.todense()
+    inter = inter.todense()
+  except: pass
+  intra = np.array(intra,dtype=np.complex128)
+  inter = np.array(inter,dtype=np.complex128)
+  energies = np.array(energies,dtype=np.complex128).reshape(-1) # energies
+  ne = len(energies) # number of energies
+  if ne>nbatch: # split in chunks
+    gs = [green_renormalization_multienergy(intra,inter,
+              energies=energies[i:i+nbatch],delta=delta,nite=nite,
+              info=info,nbatch=nbatch) for i in range(0,ne,nbatch)]
+    return (np.concatenate([g[0] for g in gs]),
+              np.concatenate([g[1] for g in gs]))
+  n = intra.shape[0] # dimension of the matrices
+  e = (energies + 1j*delta)[:,None,None]*np.identity(n)[None,:,:] # stack
+  alpha = np.repeat(inter[None,:,:],ne,axis=0) # stack of matrices
+  beta = np.repeat(inter.T.conjugate()[None,:,:],ne,axis=0)
+  epsilon = np.repeat(intra[None,:,:],ne,axis=0)
+  epsilon_s = epsilon.copy()
+  active = np.arange(ne) # energies that have not converged
+  ite = 0
+  while len(active)>0: # implementation of Eq 11
+    a = alpha[active] # active alphas
+    b = beta[active] # active betas
+    ea = e[active] - epsilon[active] # matrices to invert
+    ia = np.linalg.solve(ea,a) # einv * alpha
+    ib = np.linalg.solve(ea,b) # einv * beta
+    aib = np.matmul(a,ib) # alpha * einv * beta
+    epsilon_s[active] += aib
+    epsilon[active] += aib + np.matmul(b,ia)
+    alpha[active] = np.matmul(a,ia) # new alpha
+    beta[active] = np.matmul(b,ib) # new beta
+    ite += 1
+    # stop conditions
+    if not nite is None:
+      if ite > nite:  break 
+    else: # remove the energies that have converged
+      ma = np.max(np.abs(alpha[active]),axis=(1,2))
+      mb = np.max(np.abs(beta[active]),axis=(1,2))
+      active = active[np.logical_or(ma>=error,mb>=error)]
+  if info:
+    print("Converged in ",ite,"iterations")
+  g_surf = np.linalg.inv(e - epsilon_s) # surface green functions
+  g_bulk = np.linalg.inv(e - epsilon)  # bulk green functions
+  return g_bulk,g_surf
+
+
+
+def green_modes(intra,inter,energy=0.0,tol=1e-6):
+  """ Calculates the surface Green function of a semi-infinite lead
+  from its propagating and evanescent modes, solving the generalized
+  eigenvalue problem (E - intra - l*inter - inter.H/l) phi = 0 at real
+  energy, so it is the exact delta->0 limit. Returns the surface Green
+  function, the number of open channels and their velocities"""
+  try: # convert to dense matrices
+    intra = intra.todense()
+    inter = inter.todense()
+  except: pass
+  intra = np.array(intra,dtype=np.complex128)
+  inter = np.array(inter,dtype=np.complex128)
+  n = intra.shape[0] # dimension of the matrices
+  iden = np.identity(n,dtype=np.complex128) # identity
+  zero = np.zeros((n,n),dtype=np.complex128) # zero
+  interh = inter.T.conjugate() # hopping backwards
+  a = np.block([[zero,iden],[-interh,energy*iden - intra]])
+  b = np.block([[iden,zero],[zero,inter]])
+  (ab,vecs) = lg.eig(a,b,homogeneous_eigvals=True) # lambda = alpha/beta
+  (al,be) = (np.abs(ab[0]),np.abs(ab[1])) 
+  evan = al<be*(1.-tol) # decaying into the lead
+  prop = np.abs(al-be)<be*tol # propagating modes
+  phis = [vecs[:n,i] for i in range(2*n) if evan[i]] # decaying modes
+  lams = [ab[0][i]/ab[1][i] for i in range(2*n) if evan[i]]
+  # group the propagating modes with the same momentum
+  ip = [i for i in range(2*n) if prop[i]] # indexes
+  lp = [ab[0][i]/ab[1][i] for i in ip] # eigenvalues
+  velocities = [] # velocities of the open channels
+  done = [False for i in ip] # already assigned
+  for i in range(len(ip)):
+    if done[i]: continue
+    group = [j for j in range(len(ip)) if abs(lp[j]-lp[i])<np.sqrt(tol)]
+    for j in group: done[j] = True
+    l = lp[i] # eigenvalue of this group
+    q,r = np.linalg.qr(np.array([vecs[:n,ip[j]] for j in group]).T) 
+    # velocity operator in this subspace, dH/dk
+    dh = 1j*l*inter - 1j*np.conjugate(l)*interh
+    vs,rot = np.linalg.eigh(q.T.conjugate().dot(dh).dot(q)) # diagonalize
+    q = q.dot(rot) # rotate to the velocity eigenbasis
+    for (k,v) in enumerate(vs): 
+      if v>0.: # going into the lead
+        phis.append(q[:,k])
+        lams.append(l)
+        velocities.append(v)
+  if len(phis)!=n: # the modes do not span the cell
+    print("Mode matching failed in green_modes, using renormalization")
+    gs = green_renormalization(intra,inter,energy=energy,delta=1e-6)[1]
+    return gs,len(velocities),np.array(velocities)
+  phis = np.array(phis).T # matrix with the modes
+  x = inter.dot(phis)*np.array(lams)[None,:] # inter*Phi*Lambda
+  vf = np.linalg.solve(phis.T,x.T).T # inter*F, F the transfer matrix
+  gs = np.linalg.inv(energy*iden - intra - vf) # surface Green function
+  return np.matrix(gs),len(velocities),np.array(velocities)
+
+
+
+class surface_green_cache():
+  """Least recently used cache for the surface Green functions of
+  semi-infinite leads, keyed on a hash of the lead matrices together
+  with the energy and the analytic continuation. The stored Green
+  functions are bounded by max_memory (in MB)"""
+  def __init__(self,max_memory=500.):
+    self.max_memory = max_memory # maximum memory in MB
+    self.enabled = True # use the cache
+    self.clear()
+  def clear(self):
+    """Remove all the stored Green functions and reset the counters"""
+    from collections import OrderedDict
+    self.storage = OrderedDict() # ordered from old to new
+    self.memory = 0 # used memory in bytes
+    self.hits = 0 # number of calls found in the cache
+    self.misses = 0 # number of calls not found in the cache
+  def stats(self):
+    """Return a dictionary with the usage of the cache"""
+    return {"hits":self.hits,"misses":self.misses,
+            "entries":len(self.storage),"memory":self.memory/1e6}
+  def get(self,key):
+    """Return a stored Green function, or None if not present"""
+    g = self.storage.pop(key,None)
+    if g is None: 
+      self.misses += 1
+      return None
+    self.storage[key] = g # now it is the most recently used
+    self.hits += 1
+    return g.copy() # copy, so that the caller can not modify the cache
+  def store(self,key,g):
+    """Store a Green function, evicting the least recently used ones"""
+    if key in self.storage: return
+    size = g.nbytes # memory of this entry
+    if size>self.max_memory*1e6: return # too large to store
+    while self.memory+size>self.max_memory*1e6: # free memory
+      (k,gold) = self.storage.popitem(last=False) # oldest one
+      self.memory -= gold.nbytes
+    self.storage[key] = g.copy() # own copy of the data
+    self.memory += size
+  def surface_green(self,intra,inter,energy=0.0,delta=0.0001,
+                      solver="renormalization"):
+    """Return the surface Green function of a lead"""
+    if not self.enabled:
+      return surface_green(intra,inter,energy=energy,delta=delta,
+                             solver=solver)
+    key = (matrix_hash(intra),matrix_hash(inter),float(energy),float(delta),
+             solver)
+    g = self.get(key) # try to retrieve it
+    if g is None: # not present, compute it
+      g = surface_green(intra,inter,energy=energy,delta=delta,solver=solver)
+      self.store(key,g)
+    return g
+  def surface_green_multienergy(self,intra,inter,energies=[0.0],
+                                  delta=0.0001,solver="renormalization"):
+    """Return the surface Green functions of a lead for several energies,
+    renormalizing at once only the energies not present in the cache"""
+    if not self.enabled:
+      return surface_green_multienergy(intra,inter,energies=energies,
+                                         delta=delta,solver=solver)
+    hi = matrix_hash(intra) # hash of the matrices
+    ht = matrix_hash(inter) # hash of the matrices
+    keys = [(hi,ht,float(e),float(delta),solver) for e in energies]
+    out = [self.get(k) for k in keys] # try to retrieve them
+    missing = [i for i in range(len(out)) if out[i] is None] # not present
+    if len(missing)>0: # compute the missing ones
+      es = [energies[i] for i in missing] 
+      gs = surface_green_multienergy(intra,inter,energies=es,
+                                       delta=delta,solver=solver)
+      for (i,g) in zip(missing,gs):
+        out[i] = np.matrix(g)
+        self.store(keys[i],out[i])
+    return out
+
+
+
+def surface_green(intra,inter,energy=0.0,delta=0.0001,
+                     solver="renormalization"):
+  """Return the surface Green function of a lead with a certain solver"""
+  if solver=="renormalization":
+    return green_renormalization(intra,inter,energy=energy,delta=delta)[1]
+  elif solver=="modes": return green_modes(intra,inter,energy=energy)[0]
+  else: raise
+
+
+def surface_green_multienergy(intra,inter,energies=[0.0],delta=0.0001,
+                                solver="renormalization"):
+  """Return the surface Green functions of a lead for several energies
+  with a certain solver"""
+  if solver=="renormalization":
+    gs = green_renormalization_multienergy(intra,inter,energies=energies,
+                                               delta=delta)[1]
+    return [np.matrix(g) for g in gs]
+  elif solver=="modes": 
+    return [green_modes(intra,inter,energy=e)[0] for e in energies]
+  else: raise
+
+
+
+def matrix_hash(m):
+  """Return a hash of the content of a matrix"""
+  import hashlib
+  from scipy.sparse import issparse,csc_matrix
+  if issparse(m): # sparse matrix, hash its compressed form
+    m = csc_matrix(m,dtype=np.complex128) # copy in csc form
+    m.sum_duplicates() # canonical form
+    h = hashlib.sha1(m.data.tobytes()) # hash of the data
+    h.update(m.indices.tobytes()) # of the indexes
+    h.update(m.indptr.tobytes()) # and of the pointers
+  else:
+    m = np.ascontiguousarray(m,dtype=np.complex128)
+    h = hashlib.sha1(m.tobytes()) # hash of the data
+  h.update(str(m.shape).encode()) # and of the shape
+  return h.hexdigest()
+
+
+lead_cache = surface_green_cache() # cache shared by all the leads
+
+
+
 def bloch_selfenergy(h,nk=100,energy = 0.0, delta = 0.01,mode="full",
                          error=0.00001):
   """ Calculates the selfenergy of a cell defect,
@@ -407,20 +639,8 @@ def bloch_selfenergy(h,nk=100,energy = 0.0, delta = 0.01,mode="full",
   d = h.dimensionality # dimensionality of the system
   g = h.intra *0.0j # initialize green function
   e = np.matrix(np.identity(len(g)))*(energy + delta*1j) # complex energy
-  if mode=="full":  # full integration
-    if d==1: # one dimensional
-      ks = np.linspace(0.,1.,nk,endpoint=False) 
-    elif d==2: # two dimensional
-      ks = []
-      kk = np.linspace(0.,1.,nk,endpoint=False)  # interval 0,1
-      for ikx in kk:
-        for iky in kk:
-          ks.append([ikx,iky])
-      ks = np.array(ks)  # all the kpoints
-    else: raise # raise error
-    for k in ks:  # loop in BZ
-      g += (e - hk_gen(k)).I  # add green function  
-    g = g/len(ks)  # normalize
+  if mode=="full":  # full integration, diagonalizing the mesh once
+    g = get_spectral_green(h,nk=nk).green(energy,delta=delta)
   #####################################################
   #####################################################
   if mode=="renormalization":
@@ -438,13 +658,17 @@ def bloch_selfenergy(h,nk=100,energy = 0.0, delta = 0.01,mode="full",
     if d==1: # full renormalization
       g,s = gr(h.intra,h.inter)  # perform renormalization
     elif d==2: # two dimensional, loop over k's
-      ks = np.linspace(0.,1.,nk,endpoint=False) 
       import integration
-      def fint(k):
+      import parallel
+      def fint(hh,k):
         """ Function to integrate """
-        return green_kchain(h,k=k,energy=energy,delta=delta,error=error) 
-      # eps is error, might work....
-      g = integration.integrate_matrix(fint,xlim=[0.,1.],eps=error) 
+        return green_kchain(hh,k=[k,0.,0.],energy=energy,delta=delta,
+                              error=error) # chain in the y direction
+      sw = parallel.sweeper(fint,h) # workers shared by all the levels
+      # memoized adaptive integration, each k is only computed once
+      try: g = integration.integrate_matrix(None,xlim=[0.,1.],eps=error,
+                                              fbatch=sw.map) 
+      finally: sw.close() # kill the workers
         # chain in the y direction
     else: raise
   # now calculate selfenergy
@@ -598,15 +822,18 @@ def interface_multienergy(h1,h2,k=[0.0,0.,0.],energies=[0.0],delta=0.01,
 
 def surface_multienergy(h1,k=[0.0,0.,0.],energies=[0.0],delta=0.01,hs=None):
   """Get the Green function of an interface"""
-  from scipy.sparse import csc_matrix as csc
-  from scipy.sparse import bmat
-  fun1 = green_kchain_evaluator(h1,k=k,delta=delta,hs=hs,
-                   only_bulk=False,reverse=True) # surface green function 
-  out = [] # output
-  for energy in energies: # loop
-    gs1,sf1 = fun1(energy)
-    out.append([sf1,gs1])
-  return out # return output
+  (ons,hop) = get1dhamiltonian(h1,k,reverse=True) # get 1D Hamiltonian
+  # all the energies at once
+  gs,sf = green_renormalization_multienergy(ons,hop,energies=energies,
+                                              delta=delta)
+  if hs is not None: # surface matrix provided
+    if callable(hs): ons2 = ons + hs(k)
+    else: ons2 = ons + hs
+    hop = np.array(hop) # as array
+    sigma = np.matmul(np.matmul(hop,sf),hop.T.conjugate()) # selfenergies
+    ez = (np.array(energies)+1j*delta)[:,None,None]*np.identity(hop.shape[0])
+    sf = np.linalg.inv(ez - np.array(ons2) - sigma) # Dyson equation
+  return [[np.matrix(s),np.matrix(g)] for (s,g) in zip(sf,gs)] # output
 
 
 
@@ -681,44 +908,121 @@ def supercell_selfenergy(h,e=0.0,delta=0.001,nk=100,nsuper=[1,1]):
 def green_generator(h,nk=20):
   """Returns a function capable of calculating the Green function
   at a certain energy, by explicity summing the k-dependent Green functions"""
-  if h.dimensionality != 2: raise # only for 2d
-  shape = h.intra.shape # shape
-  hkgen = h.get_hk_gen() # get the Hamiltonian generator
-  wfs = np.zeros((nk*nk,shape[0],shape[0]),dtype=np.complex) # allocate vector
-  es = np.zeros((nk*nk,shape[0])) # allocate vector, energies
-  ks = np.zeros((nk*nk,2)) # allocate vector, energies
-  ii = 0 # counter
-  for ik in np.linspace(0.,1.,nk,endpoint=False): # loop
-    for jk in np.linspace(0.,1.,nk,endpoint=False): # loop
-      estmp,wfstmp = lg.eigh(hkgen([ik,jk])) # get eigens
-#      estmp,wfstmp = lg.eigh(hkgen(np.random.random(2))) # get eigens
-      es[ii,:] = estmp.copy() # copy
-      ks[ii,:] = np.array([ik,jk]) # store
-      wfs[ii,:,:] = wfstmp.transpose().copy() # copy
-      ii += 1 # increase counter
-  # All the wavefunctions have been calculate
-  # Now create the output function
-  from scipy.integrate import simps
+  sg = spectral_green(h,nk=nk) # diagonalize once
   def getgreen(energy,delta=0.001):
     """Return the Green function"""
-    delta = 2./nk
-#    store = np.zeros((nk*nk,shape),dtype=np.complex) # storage array
-    zero = np.matrix(np.zeros(shape),dtype=np.complex) # zero matrix
-    for ii in range(nk*nk): # loop over kpoints
-      v = energy + delta*1j - es[ii,:] # array
-      C = np.matrix(np.diag(1./v)) # matrix
-      A = np.matrix(wfs[ii,:,:]) # get the matrix with wavefunctions
-#      store[ii,:,:] = A.H*C*A # store contribution
-      zero += A.H*C*A # add contribution
-#    for i in range(shape[0]): # loop 
-#      for j in range(shape[0]): # loop 
-#        m = store[:,i,j].reshape((nk,nk)) # transform into a grid
-#        zero[i,j] =  # normalize
-    zero /= nk*nk # normalize
-    ediag = np.matrix(np.identity(shape[0]))*(energy + delta*1j)
-    selfenergy = ediag - h.intra - zero.I
-    return zero,selfenergy
+    delta = 2./nk # broadening fixed by the mesh
+    g = sg.green(energy,delta=delta) # Green function
+    return g,sg.selfenergy(g,energy,delta=delta)
   return getgreen # return function
 
 
 
+def spectral_diagonalize(hkgen,ks):
+  """Diagonalize the Bloch Hamiltonian for a list of kpoints at once,
+  returns the eigenvalues (nk,n) and the eigenvectors (nk,n,n)"""
+  hks = [] # list with the Hamiltonians
+  for k in ks: # loop over kpoints
+    hk = hkgen(k) # Bloch Hamiltonian
+    try: hk = hk.todense() # if it is sparse
+    except: pass
+    hks.append(np.asarray(hk))
+  return np.linalg.eigh(np.array(hks)) # batched diagonalization
+
+
+
+def spectral_sum(es,vs,energies,delta=0.001):
+  """Sum of V (E - e)^-1 V^dagger over the eigenstates of a chunk of
+  kpoints, for several energies, returns an (ne,n,n) array"""
+  n = vs.shape[1] # dimension of the unit cell
+  es = es.reshape(-1) # eigenvalues
+  a = vs.transpose((1,0,2)).reshape((n,-1)) # (orbital,(k,state))
+  out = np.zeros((len(energies),n,n),dtype=np.complex128) # output
+  for (j,e) in enumerate(energies): # single product per energy
+    w = 1./(e + 1j*delta - es) # resolvent in the eigenbasis
+    out[j] = (a*w).dot(a.conj().T) # sum over k and states
+  return out
+
+
+
+class spectral_green():
+  """Green function of the unit cell of a periodic system of any
+  dimensionality, G(E) = 1/N sum_k V_k (E - e_k)^-1 V_k^dagger. The
+  kpoints are processed in chunks, adding the sum of each chunk for all
+  the energies at once, so the memory is bounded by the chunk size. The
+  eigenbasis of the whole mesh is only kept if it takes less than
+  max_memory (in MB), so that later energies do not diagonalize again"""
+  def __init__(self,h,nk=20,kchunk=None,cores=None,max_memory=100.):
+    import parallel
+    d = h.dimensionality # dimensionality
+    if d<1 or d>3: raise # not implemented
+    k1 = np.linspace(0.,1.,nk,endpoint=False) # kpoints in each direction
+    ks = np.array(np.meshgrid(*[k1 for i in range(d)],indexing="ij"))
+    ks = ks.reshape((d,-1)).T # all the kpoints
+    self.n = h.intra.shape[0] # dimension of the unit cell
+    if kchunk is None: # bound the memory of each chunk to 100 MB
+      kchunk = max([1,int(1e8/(16.*self.n*self.n))])
+    self.kchunk = kchunk # kpoints in each chunk
+    self.hkgen = h.get_hk_gen() # generator of Bloch Hamiltonians
+    self.chunks = [ks[i:i+kchunk] for i in range(0,len(ks),kchunk)]
+    self.cores = cores # number of cores
+    self.nk = len(ks) # number of kpoints
+    self.intra = np.asarray(h.intra.todense() if hasattr(h.intra,"todense")
+                               else h.intra) # onsite Hamiltonian
+    self.eigen = None # eigenbasis of each chunk
+    if 16.*self.nk*self.n*self.n<max_memory*1e6: # small enough, keep it
+      self.eigen = parallel.sweep(lambda f,kc: spectral_diagonalize(f,kc),
+                         self.hkgen,self.chunks,cores=cores) # diagonalize
+  def green(self,energy,delta=0.001):
+    """Return the Green function at a certain energy"""
+    return np.matrix(self.green_multienergy([energy],delta=delta)[0])
+  def green_multienergy(self,energies,delta=0.001):
+    """Return the Green functions for several energies, (ne,n,n) array"""
+    import parallel
+    energies = np.array(energies).reshape(-1) # energies
+    out = np.zeros((len(energies),self.n,self.n),dtype=np.complex128)
+    if self.eigen is not None: # reuse the stored eigenbasis
+      for (es,vs) in self.eigen: out += spectral_sum(es,vs,energies,delta)
+    else: # diagonalize each chunk, keeping only its contribution
+      def f(hkgen,kc): 
+        (es,vs) = spectral_diagonalize(hkgen,kc) # eigenbasis of the chunk
+        return spectral_sum(es,vs,energies,delta) # sum of this chunk
+      for g in parallel.sweep_iter(f,self.hkgen,self.chunks,
+                                     cores=self.cores): out += g
+    return out/self.nk # normalize
+  def selfenergy(self,g,energy,delta=0.001):
+    """Return the selfenergy of a cell embedded in the crystal"""
+    ediag = np.identity(self.n)*(energy + delta*1j) # complex energy
+    return np.matrix(ediag - self.intra - np.linalg.inv(g))
+
+
+
+spectral_green_cache = [None,None] # last fingerprint and spectral Green
+
+
+
+def hamiltonian_hash(h):
+  """Hash of the onsite and all the hopping matrices of a Hamiltonian"""
+  hs = [matrix_hash(h.intra)] # onsite matrix
+  if h.is_multicell: # list of hoppings
+    for t in h.hopping: hs += [str(list(t.dir)),matrix_hash(t.m)]
+  else: # hoppings stored as attributes
+    for name in ["inter","tx","ty","txy","txmy","tz"]:
+      if getattr(h,name,None) is not None: 
+        hs += [name,matrix_hash(getattr(h,name))]
+  return "".join(hs)
+
+
+
+def get_spectral_green(h,nk=20):
+  """Return the spectral Green function of a Hamiltonian, reusing the
+  last one if the Hamiltonian and the mesh are the same"""
+  key = (hamiltonian_hash(h),h.dimensionality,nk) # fingerprint
+  if spectral_green_cache[0]!=key: # compute a new one
+    spectral_green_cache[1] = None # free memory
+    spectral_green_cache[1] = spectral_green(h,nk=nk)
+    spectral_green_cache[0] = key
+  return spectral_green_cache[1]
+
+
+
@@ -17,14 +17,15 @@ class heterostructure():
     from copy import deepcopy
     return deepcopy(self)
   def __init__(self,h=None):  # initialization using a hamiltonian
-    self.file_right_green = "green_right.dat"  # in/out file for right green
-    self.file_left_green = "green_left.dat"   # in/out file for left green
-    self.file_heff = "heff.dat"   # out for the effective hamiltonian
+    self.file_right_green = "green_right.npy"  # in/out file for right green
+    self.file_left_green = "green_left.npy"   # in/out file for left green
+    self.file_heff = "heff.npz"   # out for the effective hamiltonian
     self.is_sparse = False
     self.dimensionality = 1 # default is one dimensional
     self.delta = 0.0001
     self.interpolated_selfenergy = False
     self.block_diagonal = False
+    self.lead_solver = "renormalization" # or "modes", or one per lead
     if h is not None:
       self.heff = None  # effective hamiltonian
       self.right_intra = h.intra  # intraterm in the right lead
@@ -57,18 +58,22 @@ class heterostructure():
                     left_channel=left_channel,right_channel=right_channel)
   def write_green(self):
     """Writes the green functions in a file"""
-    from green import write_matrix
-    write_matrix(self.file_right_green,self.right_green)
-    write_matrix(self.file_left_green,self.left_green)
+    np.save(self.file_right_green,np.asarray(self.right_green))
+    np.save(self.file_left_green,np.asarray(self.left_green))
   def read_green(self):
     """Reads the green functions from a file"""
-    from green import read_matrix
-    self.right_green = read_matrix(self.file_right_green)
-    self.left_green = read_matrix(self.file_left_green)
+    self.right_green = np.matrix(np.load(self.file_right_green))
+    self.left_green = np.matrix(np.load(self.file_left_green))
   def write_heff(self):
     """ Writes effective hamiltonian in a file"""
-    from green import write_sparse
-    write_sparse(self.file_heff,self.heff)
+    from scipy.sparse import save_npz
+    heff = self.heff # effective Hamiltonian
+    if type(heff) is list: heff = bmat(heff) # list of lists
+    save_npz(self.file_heff,csc_matrix(heff))
+  def save(self,output_path="heterostructure.qtp",green=True):
+    """Save the heterostructure in binary form, see storage.py"""
+    import storage
+    storage.save_heterostructure(self,output_path,green=green)
   def eigenvalues(self,numeig = 10,effective=False,full=False):
     """ Calculates eigenvalues of the central part """
     return eigenvalues(self,numeig=numeig,effective=effective,
@@ -101,12 +106,11 @@ class heterostructure():
    """Return self energy of iesim lead"""
    if delta is None:  delta = self.delta
 # if the interpolation function has been created
-   if self.interpolated_selfenergy: 
-     if lead==0: return np.matrix(self.selfgen[0](energy)) # return selfenergy
-     if lead==1: return np.matrix(self.selfgen[1](energy)) # return selfenergy
+   if self.use_interpolation(energy,delta,pristine): 
+     return self.selfgen[lead](energy) # return selfenergy
 # run the calculation
    else:
-     from green import green_renormalization
+     from green import lead_cache
      if lead==0:
        intra = self.left_intra
        inter = self.left_inter
@@ -117,28 +121,115 @@ class heterostructure():
        inter = self.right_inter
        if pristine: cou = self.right_inter
        else: cou = self.right_coupling
-     ggg,gr = green_renormalization(intra,inter,energy=energy,delta=delta)
+     gr = lead_cache.surface_green(intra,inter,energy=energy,delta=delta,
+                                   solver=self.get_lead_solver(lead))
      selfr = cou*gr*cou.H # selfenergy
      return selfr # return selfenergy
+  def get_selfenergy_multienergy(self,energies,lead=0,delta=None,
+                                   pristine=False,cache=True):
+   """Return the self energies of iesim lead for a list of energies,
+   renormalizing all the energies at once. If cache is False the surface
+   Green functions are not stored in the lead cache"""
+   if delta is None:  delta = self.delta
+   out = [None for e in energies] # selfenergies
+   ii = [i for i in range(len(energies)) 
+           if self.use_interpolation(energies[i],delta,pristine)]
+   if len(ii)>0: # evaluate the interpolated ones at once
+     ss = self.selfgen[lead].evaluate([energies[i] for i in ii])
+     for (i,s) in zip(ii,ss): out[i] = np.matrix(s) # store
+   ii = [i for i in range(len(energies)) if out[i] is None] # the rest
+   if len(ii)==0: return out
+   if lead==0:
+     if pristine: cou = self.left_inter
+     else: cou = self.left_coupling
+   if lead==1:
+     if pristine: cou = self.right_inter
+     else: cou = self.right_coupling
+   grs = self.get_surface_green_multienergy([energies[i] for i in ii],
+                                             lead=lead,delta=delta,cache=cache)
+   cou = np.matrix(dense_block(cou)) # dense coupling
+   for (i,gr) in zip(ii,grs): out[i] = cou*gr*cou.H # selfenergies
+   return out
+  def use_interpolation(self,energy,delta,pristine):
+    """Check if the interpolated selfenergy can be used"""
+    if not self.interpolated_selfenergy: return False
+    if (delta,pristine)!=self.selfgen_parameters: return False
+    return self.selfgen[0].contains(energy) # inside the window
+  def get_surface_green_multienergy(self,energies,lead=0,delta=None,
+                                      cache=True):
+   """Return the surface Green functions of iesim lead for a list of
+   energies, renormalizing all the energies at once"""
+   from green import lead_cache,surface_green_multienergy
+   if delta is None:  delta = self.delta
+   if lead==0: (intra,inter) = (self.left_intra,self.left_inter)
+   if lead==1: (intra,inter) = (self.right_intra,self.right_inter)
+   if not cache: # do not store them
+     return surface_green_multienergy(intra,inter,energies=energies,
+                      delta=delta,solver=self.get_lead_solver(lead))
+   return lead_cache.surface_green_multienergy(intra,inter,
+                         energies=energies,delta=delta,
+                         solver=self.get_lead_solver(lead))
+  def get_lead_solver(self,lead=0):
+    """Return the solver used for the surface Green function of a lead"""
+    if type(self.lead_solver) is str: return self.lead_solver # same for both
+    else: return self.lead_solver[lead] # one for each lead
+  def get_lead_modes(self,energy,lead=0):
+    """Return the number of open channels and their velocities"""
+    from green import green_modes
+    if lead==0: (intra,inter) = (self.left_intra,self.left_inter)
+    if lead==1: (intra,inter) = (self.right_intra,self.right_inter)
+    (g,nopen,vs) = green_modes(intra,inter,energy=energy)
+    return nopen,vs
   def setup_selfenergy_interpolation(self,es=np.linspace(-4.0,4.0,100),
-           delta=0.0001,pristine=False):
-    """Create the functions that interpolate the selfenergy"""
-    from interpolation import intermatrix
+           delta=0.0001,pristine=False,tol=1e-4,input_file=None):
+    """Create piecewise Chebyshev expansions of the selfenergies in the
+    window of es, with an error below tol. Outside the window, or for
+    other delta, the selfenergies are computed as usual. If input_file
+    is provided the expansions are read from it"""
+    from interpolation import chebyshev_fit,load_chebyshev
     self.interpolated_selfenergy = False # set as False
-    fsl = lambda e: self.get_selfenergy(e,delta=delta,lead=0,pristine=pristine)
-    fsr = lambda e: self.get_selfenergy(e,delta=delta,lead=1,pristine=pristine)
-    fun_sr = intermatrix(fsr,xs=es) # get the function
-    fun_sl = intermatrix(fsl,xs=es) # get the function
-    self.selfgen = [fun_sl,fun_sr] # store functions
+    if input_file is not None: # read from a file
+      selfgen,d = load_chebyshev(input_file)
+      if str(d.get("fingerprint",""))!=self.lead_fingerprint(): 
+        raise ValueError("Selfenergies in "+str(input_file)+
+                           " belong to different leads")
+      self.selfgen = selfgen # store
+      self.selfgen_parameters = (float(d["delta"]),bool(d["pristine"]))
+    else: # compute the expansions
+      xlim = [np.min(es),np.max(es)] # window
+      fs = [lambda x,l=l: self.get_selfenergy_multienergy(x,lead=l,
+                  delta=delta,pristine=pristine,cache=False) for l in [0,1]]
+      self.selfgen = [chebyshev_fit(f,xlim=xlim,tol=tol) for f in fs]
+      self.selfgen_parameters = (delta,pristine) # parameters
     self.interpolated_selfenergy = True # set as true
-  def didv(self,energy=0.0,delta=None,error=1e-4,nk=500,kwant=False):
+  def write_selfenergy_interpolation(self,output_file="SELFENERGY.npz"):
+    """Write the expansions of the selfenergies in a file"""
+    from interpolation import save_chebyshev
+    if not self.interpolated_selfenergy: raise # nothing to write
+    (delta,pristine) = self.selfgen_parameters
+    save_chebyshev(self.selfgen,output_file,delta=delta,pristine=pristine,
+                     fingerprint=self.lead_fingerprint())
+  def lead_fingerprint(self):
+    """Hash of the matrices of the leads and their couplings"""
+    ms = [self.left_intra,self.left_inter,self.right_intra,
+            self.right_inter,self.left_coupling,self.right_coupling] 
+    return "".join([green.matrix_hash(m) for m in ms])
+  def didv(self,energy=0.0,delta=None,error=1e-4,nk=500,kwant=False,
+              adaptive=True):
     if delta is None: delta = self.delta # set the own delta
     if self.dimensionality==1: # one dimensional
       return didv(self,energy=energy,delta=delta,kwant=kwant) # return value
     elif self.dimensionality==2: # two dimensional
+      import parallel
       # function to integrate
-      f = lambda k: self.generate(k).didv(energy=energy,delta=delta)
-      return np.mean([f(x) for x in np.linspace(0.,1.,nk,endpoint=False)])
+      f = lambda ht,k: ht.generate(k).didv(energy=energy,delta=delta)
+      if adaptive: # adaptive integration, refining close to the kinks
+        from integration import batch_simpson
+        sw = parallel.sweeper(f,self) # workers shared by all the levels
+        try: return batch_simpson(sw.map,xlim=[0.,1.],eps=error)[0]
+        finally: sw.close() # kill the workers
+      ks = np.linspace(0.,1.,nk,endpoint=False) # kpoints
+      return np.mean(parallel.sweep(f,self,ks,chunksize=max([1,nk//50])))
     else: raise
   def block2full(self,sparse=False):
     """Put in full form"""
@@ -312,30 +403,34 @@ def plot_central_dos(ht,energies=[0.0],num_rep=100,
 
 def landauer(hetero,energy=0.0,delta = 0.0001,error=0.0000001,do_leads=True,
              gr=None,gl=None,has_eh=False,right_channel=None,
-             left_channel=None):
+             left_channel=None,selfl=None,selfr=None):
    """ Calculates transmission using Landauer formula"""
    if not do_leads: # if use old Green function, ensure that they are right
      if energy != hetero.energy_green: 
        do_leads = True
        print("Wrong energy in Landauer, recalculating Green functions")
 
-   try: # if it is a list
+   if np.ndim(energy)>0: # if it is a list, get all the selfenergies at once
+     if not hetero.block_diagonal: # store the lead Green functions
+       for lead in [0,1]: 
+         hetero.get_surface_green_multienergy(energy,lead=lead,delta=delta)
+       return [landauer(hetero,energy=e,delta=delta,error=error,
+                        do_leads=do_leads,gr=gr,gl=gl,has_eh=has_eh) 
+                  for e in energy]
+     selfls = hetero.get_selfenergy_multienergy(energy,lead=0,delta=delta)
+     selfrs = hetero.get_selfenergy_multienergy(energy,lead=1,delta=delta)
      return [landauer(hetero,energy=e,delta=delta,error=error,
-                      do_leads=do_leads,gr=gr,gl=gl,has_eh=has_eh) for e in energy]
-   except: # contnue if it is not a list
-     pass
-   import green
-   from hamiltonians import is_number
-   if not hetero.block_diagonal:
-     intra = hetero.central_intra # central intraterm   
-     dimhc = len(intra) # dimension of the central part
-   if hetero.block_diagonal:
-     intra = hetero.central_intra[0][0] # when it is diagonal
-# dimension of the central part
-     dimhc = len(hetero.central_intra)*intra.shape[0] 
-   iden = np.matrix(np.identity(len(intra),dtype=complex)) # create idntity
-   selfl = hetero.get_selfenergy(energy,lead=0,delta=delta,pristine=False) # left Sigma
-   selfr = hetero.get_selfenergy(energy,lead=1,delta=delta,pristine=False) # right Sigma
+                      do_leads=do_leads,gr=gr,gl=gl,has_eh=has_eh,
+                      selfl=sl,selfr=sr) 
+                for (e,sl,sr) in zip(energy,selfls,selfrs)]
+   if not hetero.block_diagonal: # full matrix, use a sparse factorization
+     if has_eh: raise # if it has electron-hole, trace over electrons
+     return sparse_landauer(hetero,energy=energy,delta=delta,
+                              selfl=selfl,selfr=selfr)
+   if selfl is None: # left Sigma
+     selfl = hetero.get_selfenergy(energy,lead=0,delta=delta,pristine=False)
+   if selfr is None: # right Sigma
+     selfr = hetero.get_selfenergy(energy,lead=1,delta=delta,pristine=False)
    #################################
    # calculate Gammas 
    #################################
@@ -347,39 +442,145 @@ def landauer(hetero,energy=0.0,delta = 0.0001,error=0.0000001,do_leads=True,
    #################################
    # central green function
    intra = hetero.central_intra
-   # full matrix
-   if not hetero.block_diagonal:
-     heff = intra + selfl + selfr
-     hetero.heff = heff
-     gc = (energy+1j*delta)*iden - heff
-     gc = gc.I # calculate inverse
-     if has_eh: raise # if it has electron-hole, trace over electrons
-     G = (gammar*gc*gammal*gc.H).trace()[0,0].real
-     return G
-   # reduced matrix
-   if hetero.block_diagonal: 
-     from copy import deepcopy
-     heff = deepcopy(intra)
-     heff[0][0] = intra[0][0] + selfl
-     heff[-1][-1] = intra[-1][-1] + selfr
-     dd = (energy+1j*delta)*iden
-     for i in range(len(intra)):  # add the diagonal energy part
-       heff[i][i] = heff[i][i] - dd  # this has the wrong sign!!
-    # now change the sign
-     for i in range(len(intra)):  
-       for j in range(len(intra)):  
-         if heff[i][j] is not None:
-           heff[i][j] = -heff[i][j]
-     # calculate green function
-     from green import gauss_inverse  # routine to invert the matrix
-     # calculate only some elements of the central green function
-     gcn1 = gauss_inverse(heff,len(heff)-1,0) # calculate element 1,n 
-     # and apply Landauer formula
-     G = (gammar*gcn1*gammal*gcn1.H).trace()[0,0].real
+   # E - H - Sigma in block tridiagonal form
+   heff = effective_tridiagonal_hamiltonian(intra,selfl,selfr,
+                                      energy=energy,delta=delta)
+   # calculate only the corner elements of the central green function
+   (g11,g1n,gcn1,gnn) = rgf_green(heff) # recursive green function
+   # and apply Landauer formula
+   G = (gammar*gcn1*gammal*gcn1.H).trace()[0,0].real
    return G # return transmission
 
 
 
+def sparse_landauer(hetero,energy=0.0,delta=0.0001,selfl=None,selfr=None):
+   """ Calculates the Landauer transmission of a heterostructure whose
+   central part is a single (sparse) matrix. E - H - Sigma is factorized
+   once and only the columns of the Green function touching the
+   left lead are computed"""
+   from scipy.sparse import identity
+   hc = csc_matrix(hetero.central_intra) # central Hamiltonian
+   n = hc.shape[0] # dimension of the central part
+   il = interface_indexes(hetero.left_coupling) # sites touching the left
+   ir = interface_indexes(hetero.right_coupling) # sites touching the right
+   if len(il)==0 or len(ir)==0: return 0.0 # decoupled leads
+   if selfl is None or selfr is None: # selfenergies in the interfaces
+     (gl,gr) = get_surface_green(hetero,energy=energy,delta=delta)
+     cl = np.matrix(csc_matrix(hetero.left_coupling)[il,:].todense())
+     cr = np.matrix(csc_matrix(hetero.right_coupling)[ir,:].todense())
+     selfl = cl*gl*cl.H # left selfenergy
+     selfr = cr*gr*cr.H # right selfenergy
+   else: # restrict the selfenergies to the interfaces
+     selfl = np.matrix(dense_block(selfl)[np.ix_(il,il)])
+     selfr = np.matrix(dense_block(selfr)[np.ix_(ir,ir)])
+   gammal = 1j*(selfl-selfl.H) # left gamma
+   gammar = 1j*(selfr-selfr.H) # right gamma
+   m = (energy+1j*delta)*identity(n,format="csc") - hc # E - H
+   m = m - embed_block(selfl,il,n) - embed_block(selfr,ir,n) # selfenergies
+   gcols = sparse_green_columns(m,il) # columns of the left interface
+   grl = np.matrix(gcols[ir,:]) # G between right and left interfaces
+   return (gammar*grl*gammal*grl.H).trace()[0,0].real # transmission
+
+
+
+def block_tridiagonal_partition(hc,il,ir):
+  """Return a list of slices (arrays of indexes) that put the sparse
+  matrix hc in block tridiagonal form, with the indexes il in the
+  first slice and the indexes ir in the last one. Slices are layers
+  of a breadth first search from il, the layers beyond the first one
+  reaching ir are merged in the last slice, and consecutive small
+  slices are merged as long as they do not exceed the largest one"""
+  hc = csc_matrix(hc) # sparse matrix
+  n = hc.shape[0] # dimension
+  graph = coo_matrix(hc)
+  keep = np.abs(graph.data)>0. # nonzero entries
+  graph = csc_matrix((np.ones(np.sum(keep)),
+                  (graph.row[keep],graph.col[keep])),shape=(n,n))
+  graph = (graph + graph.T).tocsr() # symmetric connectivity
+  layer = np.zeros(n,dtype=int) - 1 # layer of each site
+  front = np.unique(np.array(il,dtype=int)) # first layer
+  layer[front] = 0
+  nl = 0 # index of the last layer
+  while len(front)>0: # breadth first search
+    neigh = np.unique(graph[front,:].indices) # neighbors of the front
+    front = neigh[layer[neigh]<0] # sites not visited
+    if len(front)==0: break
+    nl += 1
+    layer[front] = nl
+  layer[layer<0] = nl # disconnected sites go to the last layer
+  ir = np.array(ir,dtype=int) # right interface
+  if len(ir)>0: # merge everything beyond the first layer touching ir
+    layer[layer>np.min(layer[ir])] = np.min(layer[ir])
+  slices = [np.where(layer==i)[0] for i in range(np.max(layer)+1)]
+  # balancing pass, merge consecutive small slices
+  nmax = max([len(sl) for sl in slices]) # size of the largest slice
+  out = [slices[0]]
+  for sl in slices[1:]:
+    if len(out[-1])+len(sl)<=nmax: # merge with the previous one
+      out[-1] = np.concatenate([out[-1],sl])
+    else: out.append(sl)
+  return out
+
+
+
+def partition(ht,slices=None):
+  """Return a block diagonal heterostructure from a heterostructure
+  whose central part is a single matrix, using an automatic block
+  tridiagonal partition. The new ordering of the central sites is
+  stored in central_order"""
+  if ht.block_diagonal: return ht # nothing to do
+  hc = csc_matrix(ht.central_intra) # central Hamiltonian
+  il = interface_indexes(ht.left_coupling) # sites touching the left
+  ir = interface_indexes(ht.right_coupling) # sites touching the right
+  if slices is None: slices = block_tridiagonal_partition(hc,il,ir)
+  if len(slices)==1: return ht # a single block
+  ho = ht.copy() # copy heterostructure
+  nb = len(slices) # number of blocks
+  hb = [[None for i in range(nb)] for j in range(nb)] # central blocks
+  for i in range(nb): 
+    hb[i][i] = np.matrix(hc[slices[i],:][:,slices[i]].todense())
+  for i in range(nb-1):
+    hb[i][i+1] = np.matrix(hc[slices[i],:][:,slices[i+1]].todense())
+    hb[i+1][i] = np.matrix(hc[slices[i+1],:][:,slices[i]].todense())
+  ho.central_intra = hb # store
+  lc = csc_matrix(ht.left_coupling) # left coupling
+  rc = csc_matrix(ht.right_coupling) # right coupling
+  ho.left_coupling = np.matrix(lc[slices[0],:].todense())
+  ho.right_coupling = np.matrix(rc[slices[-1],:].todense())
+  ho.central_order = np.concatenate(slices) # ordering of the sites
+  ho.block_diagonal = True
+  return ho
+
+
+
+def interface_indexes(coupling):
+  """Return the indexes of the central part coupled to a lead"""
+  c = coo_matrix(coupling) # coupling from the center to the lead
+  return np.unique(c.row[np.abs(c.data)>0.]) # rows with nonzero coupling
+
+
+
+def embed_block(m,ii,n):
+  """Return a sparse nxn matrix with the block m in the indexes ii"""
+  ii = np.array(ii) # indexes
+  rows = np.repeat(ii,len(ii)) # row indexes
+  cols = np.tile(ii,len(ii)) # column indexes
+  data = np.asarray(m).reshape(-1) # values
+  return csc_matrix((data,(rows,cols)),shape=(n,n),dtype=np.complex128)
+
+
+
+def sparse_green_columns(m,cols):
+  """Return several columns of the inverse of a sparse matrix,
+  using a single sparse LU factorization"""
+  from scipy.sparse.linalg import splu
+  lu = splu(csc_matrix(m,dtype=np.complex128)) # factorize
+  rhs = np.zeros((m.shape[0],len(cols)),dtype=np.complex128) # unit vectors
+  rhs[np.array(cols),np.arange(len(cols))] = 1.0
+  return lu.solve(rhs) # columns of the inverse
+
+
+
 
 
 def block2full(ht,sparse=False):
@@ -746,10 +947,18 @@ def effective_central_hamiltonian(hetero,energy=0.0,delta=0.0001,write=False):
    return heff
 
 
-def didv(ht,energy=0.0,delta=0.00001,kwant=False):
+def didv(ht,energy=0.0,delta=0.00001,kwant=False,selfl=None,selfr=None):
   """Calculate differential conductance"""
+  if np.ndim(energy)>0 and not kwant: # list, get all the selfenergies at once
+    selfls = ht.get_selfenergy_multienergy(energy,lead=0,delta=delta,
+                                             pristine=True)
+    selfrs = ht.get_selfenergy_multienergy(energy,lead=1,delta=delta,
+                                             pristine=True)
+    return [didv(ht,energy=e,delta=delta,selfl=sl,selfr=sr) 
+                for (e,sl,sr) in zip(energy,selfls,selfrs)]
   if ht.has_eh: # for systems with electons and holes
-    s = get_smatrix(ht,energy=energy,delta=delta,check=True) # get the smatrix
+    s = get_smatrix(ht,energy=energy,delta=delta,
+                      selfl=selfl,selfr=selfr) # get the smatrix
     r1,r2 = s[0][0],s[1][1] # get the reflection matrices
     get_eh = ht.get_eh_sector # function to read either electron or hole
     # select the normal lead
@@ -768,7 +977,8 @@ def didv(ht,energy=0.0,delta=0.00001,kwant=False):
     if kwant:
       import kwantlink 
       return kwantlink.transport(ht,energy)
-    s = get_smatrix(ht,energy=energy,delta=delta,check=True) # get the smatrix
+    s = get_smatrix(ht,energy=energy,delta=delta,
+                      selfl=selfl,selfr=selfr) # get the smatrix
     r1,r2,t = s[0][0],s[1][1],s[0][1] # get the reflection matrices
     # select the normal lead
     # r1 is normal
@@ -789,64 +999,171 @@ def get_tmatrix(ht,energy=0.0,delta=0.0001):
 
 
 
-def get_smatrix(ht,energy=0.0,delta=0.000001,as_matrix=False,check=True):
-  """Calculate the S-matrix of an heterostructure"""
+smatrix_check = "sampled" # default unitarity check, off/sampled/always
+
+def get_smatrix(ht,energy=0.0,delta=0.000001,as_matrix=False,check=None,
+                  selfl=None,selfr=None):
+  """Calculate the S-matrix of an heterostructure. The unitarity check
+  can be "off", "sampled" (a few random vectors) or "always" (full
+  S^dagger S - 1), by default smatrix_check is used"""
   # now do the Fisher Lee trick
   smatrix = [[None,None],[None,None]] # smatrix in list form
-  from green import gauss_inverse # calculate the desired green functions
   # get the selfenergies, using the same coupling as the lead
-  selfl = ht.get_selfenergy(energy,delta=delta,lead=0,pristine=True)
-  selfr = ht.get_selfenergy(energy,delta=delta,lead=1,pristine=True)
+  if selfl is None:
+    selfl = ht.get_selfenergy(energy,delta=delta,lead=0,pristine=True)
+  if selfr is None:
+    selfr = ht.get_selfenergy(energy,delta=delta,lead=1,pristine=True)
   if ht.block_diagonal:
-    ht2 = enlarge_hlist(ht) # get the enlaged hlist with the leads
+    hlist = enlarged_central_list(ht) # hlist with a cell of each lead
 # selfenergy of the leads (coupled to another cell of the lead)
-    gmatrix = effective_tridiagonal_hamiltonian(ht2.central_intra,selfl,selfr,
+    gmatrix = effective_tridiagonal_hamiltonian(hlist,selfl,selfr,
                                                  energy=energy,delta=delta) 
-    test_gauss = False # do the tridiagonal inversion
 #    print(selfr)
   else: # not block diagonal
     gmatrix = build_effective_hlist(ht,energy=energy,delta=delta,selfl=selfl,
                                     selfr=selfr)
-    test_gauss = True # gauss only works with square matrices
 #    print(selfr)
   # gamma functions
   gammar = 1j*(selfr-selfr.H)
   gammal = 1j*(selfl-selfl.H)
   # calculate the relevant terms of the Green function
-  g11 = gauss_inverse(gmatrix,0,0,test=test_gauss)
-  g12 = gauss_inverse(gmatrix,0,-1,test=test_gauss)
-  g21 = gauss_inverse(gmatrix,-1,0,test=test_gauss)
-  g22 = gauss_inverse(gmatrix,-1,-1,test=test_gauss)
+  if ht.block_diagonal: # single recursive sweep
+    (g11,g12,g21,g22) = rgf_green(gmatrix)
+  else: # sparse factorization, only the columns of the leads
+    from scipy.sparse import bmat,csc_matrix
+    m = bmat([[csc_matrix(b) if b is not None else None for b in row] 
+                   for row in gmatrix]) # sparse matrix
+    nl = gmatrix[0][0].shape[0] # dimension of the left lead
+    nr = gmatrix[2][2].shape[0] # dimension of the right lead
+    nt = m.shape[0] # total dimension
+    gcols = sparse_green_columns(m,list(range(nl))+list(range(nt-nr,nt)))
+    g11 = np.matrix(gcols[:nl,:nl])
+    g12 = np.matrix(gcols[:nl,nl:])
+    g21 = np.matrix(gcols[nt-nr:,:nl])
+    g22 = np.matrix(gcols[nt-nr:,nl:])
 #  print("NAN",np.sum(np.isnan(g12)))
 #  print (gammal*g12*gammar*g21).trace()
   ######## now build up the s matrix with the fisher trick
-  # the identity can have different dimension ignore for now....
-  iden = np.matrix(np.identity(g11.shape[0],dtype=complex)) # create identity
   iden11 = np.matrix(np.identity(g11.shape[0],dtype=complex)) # create identity
   iden22 = np.matrix(np.identity(g22.shape[0],dtype=complex)) # create identity
-  smatrix[0][0] = -iden + 1j*sqrtm(gammal)*g11*sqrtm(gammal) # matrix
-  smatrix[0][1] = 1j*sqrtm(gammal)*g12*sqrtm(gammar) # transmission matrix
-  smatrix[1][0] = 1j*sqrtm(gammar)*g21*sqrtm(gammal) # transmission matrix
-  smatrix[1][1] = -iden + 1j*sqrtm(gammar)*g22*sqrtm(gammar) # matrix
-  if check: # check whether the matrix is unitary
-      from scipy.sparse import bmat,csc_matrix
-      smatrix2 = [[csc_matrix(smatrix[i][j]) for j in range(2)] for i in range(2)]
-      smatrix2 = bmat(smatrix2).todense()
-  #    print("Determinant",np.abs(np.linalg.det(smatrix2)))
-      error = np.max(np.abs(smatrix2.I -smatrix2.H)) #  check unitarity
+  sl = sqrtm(gammal) # square root of the left gamma, only once
+  sr = sqrtm(gammar) # square root of the right gamma, only once
+  smatrix[0][0] = -iden11 + 1j*sl*g11*sl # matrix
+  smatrix[0][1] = 1j*sl*g12*sr # transmission matrix
+  smatrix[1][0] = 1j*sr*g21*sl # transmission matrix
+  smatrix[1][1] = -iden22 + 1j*sr*g22*sr # matrix
+  if check is None: check = smatrix_check # default check
+  if check is True: check = "always"
+  if check is False: check = "off"
+  if check!="off": # check whether the matrix is unitary
+      error = unitarity_error(smatrix,mode=check) #  check unitarity
       if error> 100*delta: 
         print("S-matrix is not unitary",error)
 #        raise
   if as_matrix: 
-    from scipy.sparse import bmat,csc_matrix
-    smatrix2 = [[csc_matrix(smatrix[i][j]) for j in range(2)] for i in range(2)]
-    smatrix = bmat(smatrix2).todense()
+    smatrix = np.matrix(np.block(smatrix)) # dense matrix
   return smatrix
 
 
+
+def unitarity_error(smatrix,mode="always",nsample=2):
+  """Return the deviation from unitarity of an S-matrix in list form,
+  either the full S^dagger S - 1 or its action on a few random vectors.
+  Both are computed with the blocks, without building the full matrix"""
+  sb = [[np.asarray(b) for b in row] for row in smatrix] # blocks
+  ns = [sb[0][0].shape[1],sb[1][1].shape[1]] # dimensions of the blocks
+  if mode=="always": # full residual, O(n^3)
+    error = 0. # initialize
+    for i in range(2):
+      for j in range(2):
+        sds = sb[0][i].conj().T.dot(sb[0][j]) + sb[1][i].conj().T.dot(sb[1][j])
+        if i==j: sds = sds - np.identity(ns[i]) # subtract identity
+        error = max([error,np.max(np.abs(sds))]) # maximum deviation
+    return error
+  elif mode=="sampled": # apply to random vectors, O(n^2)
+    vs = [] # random vectors for each block
+    for n in ns:
+      vs.append(np.random.random((n,nsample)) - .5 + 1j*(np.random.random((n,nsample))-.5))
+    norm = np.sqrt(np.sum(np.abs(vs[0])**2,axis=0) + np.sum(np.abs(vs[1])**2,axis=0))
+    vs = [v/norm for v in vs] # normalize
+    ws = [sb[i][0].dot(vs[0]) + sb[i][1].dot(vs[1]) for i in range(2)] # S v
+    us = [sb[0][j].conj().T.dot(ws[0]) + sb[1][j].conj().T.dot(ws[1])
+             for j in range(2)] # S^dagger S v
+    return max([np.max(np.abs(us[j] - vs[j])) for j in range(2)]) # residual
+  else: raise
+
+
+def get_smatrix_derivative(ht,dH_central,energy=0.0,delta=0.000001,
+                             as_matrix=False):
+  """Calculate the derivative of the S-matrix with respect to a parameter
+  X of the central part, dS = i Gamma^1/2 G dH/dX G Gamma^1/2, with
+  dH_central the derivative of the central Hamiltonian (list of blocks
+  for block diagonal heterostructures, a matrix otherwise). A list of
+  derivatives can be provided, and all are computed from the same
+  factorization"""
+  from scipy.sparse.linalg import splu
+  if ht.block_diagonal: single = type(dH_central[0][0]) is not list
+  else: single = type(dH_central) is not list
+  if single: dH_central = [dH_central] # list of perturbations
+  selfl = ht.get_selfenergy(energy,delta=delta,lead=0,pristine=True)
+  selfr = ht.get_selfenergy(energy,delta=delta,lead=1,pristine=True)
+  if ht.block_diagonal: # enlarged list with a cell of each lead
+    gmatrix = effective_tridiagonal_hamiltonian(enlarged_central_list(ht),
+                               selfl,selfr,energy=energy,delta=delta) 
+  else: # central part as a single block
+    gmatrix = build_effective_hlist(ht,energy=energy,delta=delta,selfl=selfl,
+                                    selfr=selfr)
+  nb = len(gmatrix) # number of blocks
+  ds = [gmatrix[i][i].shape[0] for i in range(nb)] # dimension of the blocks
+  m = bmat([[csc_matrix(b) if b is not None else None for b in row] 
+                   for row in gmatrix]) # sparse matrix
+  nl,nr,nt = ds[0],ds[-1],m.shape[0] # dimensions
+  cols = list(range(nl))+list(range(nt-nr,nt)) # indexes of the leads
+  rhs = np.zeros((nt,len(cols)),dtype=np.complex128) # unit vectors
+  rhs[np.array(cols),np.arange(len(cols))] = 1.0
+  lu = splu(csc_matrix(m,dtype=np.complex128)) # single factorization
+  gc = lu.solve(rhs) # columns of the leads, G[:,leads]
+  gr = lu.solve(rhs,trans="T").T # rows of the leads, G[leads,:]
+  # square roots of the gammas
+  sl = sqrtm(1j*(selfl-selfl.H)) 
+  sr = sqrtm(1j*(selfr-selfr.H))
+  sq = bmat([[csc_matrix(sl),None],[None,csc_matrix(sr)]]).toarray()
+  out = [] # list with the derivatives
+  for dh in dH_central:
+    if ht.block_diagonal: # pad with zeros in the lead cells
+      dhl = [[None for i in range(nb)] for j in range(nb)]
+      for i in range(nb):
+        dhl[i][i] = csc_matrix((ds[i],ds[i]),dtype=np.complex128) # zero
+      for i in range(nb-2):
+        for j in range(nb-2):
+          if dh[i][j] is not None: dhl[i+1][j+1] = csc_matrix(dh[i][j])
+    else:
+      dhl = [[csc_matrix((nl,nl)),None,None],[None,csc_matrix(dh),None],
+                [None,None,csc_matrix((nr,nr))]]
+    dhl = bmat(dhl).tocsc() # perturbation in the full space
+    dg = gr.dot(dhl.dot(gc)) # G dH G between the leads
+    dsm = np.matrix(1j*sq.dot(dg).dot(sq)) # derivative of the S-matrix
+    if as_matrix: out.append(dsm)
+    else: out.append([[dsm[:nl,:nl],dsm[:nl,nl:]],[dsm[nl:,:nl],dsm[nl:,nl:]]])
+  if single: return out[0]
+  else: return out
+
+
+
 def enlarge_hlist(ht):
   """Add a single cell of the leads to the central part"""
   ho = ht.copy() # copy heterostructure
+  # store in the object
+  ho.central_intra = enlarged_central_list(ht)
+  # and redefine the new lead couplings
+  ho.right_coupling = ht.right_inter
+  ho.left_coupling = ht.left_inter
+  return ho
+
+
+def enlarged_central_list(ht):
+  """Return the list of central blocks with a single cell of the
+  leads added, without copying the heterostructure"""
   if not ht.block_diagonal: raise # check that is in block diagonal form
   nc = len(ht.central_intra) # number of cells in the central
   hcentral = [[None for i in range(nc+2)] for j in range(nc+2)]
@@ -862,28 +1179,24 @@ def enlarge_hlist(ht):
   hcentral[-1][-1] = ht.right_intra # right
   hcentral[-2][-1] = ht.right_coupling # right
   hcentral[-1][-2] = ht.right_coupling.H # right
-  # store in the object
-  ho.central_intra = hcentral    
-  # and redefine the new lead couplings
-  ho.right_coupling = ht.right_inter
-  ho.left_coupling = ht.left_inter
-  return ho
+  return hcentral
 
 
 def build_effective_hlist(ht,energy=0.0,delta=0.0001,selfl=None,selfr=None):
   """ Calculate list of effective Hamiltonian which will be inverted"""
   if (selfl is None) or (selfr is None):
     (selfl,selfr) = get_surface_selfenergies(ht,energy=energy,delta=delta) 
-  intra = ht.central_intra # central intracell hamiltonian
+  from scipy.sparse import identity
+  intra = csc_matrix(ht.central_intra) # central intracell hamiltonian
   ce = energy +1j*delta
-  idenc = np.matrix(np.identity(len(ht.central_intra),dtype=complex))*ce
-  idenl = np.matrix(np.identity(len(ht.left_intra),dtype=complex))*ce 
-  idenr = np.matrix(np.identity(len(ht.right_intra),dtype=complex))*ce 
+  idenc = identity(intra.shape[0],dtype=complex,format="csc")*ce # sparse
+  idenl = np.matrix(np.identity(ht.left_intra.shape[0],dtype=complex))*ce 
+  idenr = np.matrix(np.identity(ht.right_intra.shape[0],dtype=complex))*ce 
   hlist = [[None for i in range(3)] for j in range(3)] # list of matrices
   # set up the different elements
   # first the intra terms
   hlist[0][0] = idenl - ht.left_intra - selfl
-  hlist[1][1] = idenc - ht.central_intra
+  hlist[1][1] = idenc - intra
   hlist[2][2] = idenr - ht.right_intra - selfr
   # now the inter cell
   hlist[0][1] = -ht.left_coupling.H
@@ -929,16 +1242,18 @@ def sqrtm_rotated(M):
 
 def get_surface_green(hetero,energy=0.0,delta=0.0001):
    """Calculate left and right greeen functions"""
-   from green import green_renormalization
+   from green import lead_cache
    # right lead
    intra = hetero.right_intra
    inter = hetero.right_inter
-   ggg,gr = green_renormalization(intra,inter,energy=energy,delta=delta)
+   gr = lead_cache.surface_green(intra,inter,energy=energy,delta=delta,
+                                 solver=hetero.get_lead_solver(1))
 #   hetero.right_green = gr # save green function
    # left lead
    intra = hetero.left_intra
    inter = hetero.left_inter
-   ggg,gl = green_renormalization(intra,inter,energy=energy,delta=delta)
+   gl = lead_cache.surface_green(intra,inter,energy=energy,delta=delta,
+                                 solver=hetero.get_lead_solver(0))
    return (gl,gr)
 
 
@@ -1000,9 +1315,9 @@ def effective_tridiagonal_hamiltonian(intra,selfl,selfr,
   if not type(intra) is list: raise # assume is list
   n = len(intra) # number of blocks
   iout = [[None for i in range(n)] for j in range(n)] # empty list
-  iden = np.matrix(np.identity(intra[0][0].shape[0],dtype=np.complex))
-  ez = iden*(energy +1j*delta) # complex energy
   for i in range(n):
+    iden = np.matrix(np.identity(intra[i][i].shape[0],dtype=np.complex))
+    ez = iden*(energy +1j*delta) # complex energy
     iout[i][i] = ez - intra[i][i] # simply E -H
   for i in range(n-1):
     iout[i][i+1] = -intra[i][i+1] # simply E -H
@@ -1015,6 +1330,338 @@ def effective_tridiagonal_hamiltonian(intra,selfl,selfr,
 
 
 
+def rgf_green(m,diagonal=False):
+  """Recursive Green function algorithm for a block tridiagonal
+  matrix m = E - H - Sigma, given as a list of lists. A single sweep
+  from left to right returns the blocks G_11, G_1N, G_N1 and G_NN
+  of the inverse, keeping in memory only the last left-connected
+  Green function. If diagonal is True, the left-connected Green
+  functions are stored and a backward sweep also returns the
+  list of diagonal blocks G_ii"""
+  nb = len(m) # number of blocks
+  gl = np.linalg.inv(dense_block(m[0][0])) # left connected green function
+  g11 = gl.copy() # G_11 of the first i blocks
+  g1n = gl.copy() # G_1i of the first i blocks
+  gn1 = gl.copy() # G_i1 of the first i blocks
+  if diagonal: gls = [gl] # store left connected green functions
+  for i in range(1,nb): # sweep to the right
+    u = dense_block(m[i-1][i]) # coupling i-1 -> i
+    d = dense_block(m[i][i-1]) # coupling i -> i-1
+    gl = np.linalg.inv(dense_block(m[i][i]) - d.dot(gl).dot(u)) # Dyson
+    g1u = g1n.dot(u) # auxiliary product
+    dg1 = d.dot(gn1) # auxiliary product
+    g11 = g11 + g1u.dot(gl).dot(dg1) # update G_11
+    g1n = -g1u.dot(gl) # update G_1i
+    gn1 = -gl.dot(dg1) # update G_i1
+    if diagonal: gls.append(gl) # store
+  gnn = gl # the last left connected is the full G_NN
+  out = (np.matrix(g11),np.matrix(g1n),np.matrix(gn1),np.matrix(gnn))
+  if not diagonal: return out
+  # backward sweep for the diagonal blocks
+  gd = [None for i in range(nb)] # diagonal blocks
+  gd[nb-1] = gnn # last one
+  for i in range(nb-2,-1,-1): # sweep to the left
+    u = dense_block(m[i][i+1]) # coupling i -> i+1
+    d = dense_block(m[i+1][i]) # coupling i+1 -> i
+    gd[i] = gls[i] + gls[i].dot(u).dot(gd[i+1]).dot(d).dot(gls[i])
+  gd = [np.matrix(g) for g in gd] # convert to matrices
+  return out + (gd,)
+
+
+def fermi(energies,mu=0.0,temperature=0.0):
+  """Fermi Dirac distribution"""
+  x = (np.array(energies)-mu) # energies
+  if temperature==0.: return (1.0 - np.sign(x))/2. # step function
+  return (1.0 - np.tanh(x/(2.*temperature)))/2. # stable form
+
+
+
+def heterostructure_hash(ht):
+  """Return a hash of all the matrices of a heterostructure"""
+  ms = [ht.left_intra,ht.left_inter,ht.right_intra,ht.right_inter,
+          ht.left_coupling,ht.right_coupling] # leads and couplings
+  if ht.block_diagonal: # list of lists
+    ms += [m for row in ht.central_intra for m in row if m is not None]
+  else: ms.append(ht.central_intra) # single matrix
+  return "".join([green.matrix_hash(m) for m in ms])
+
+
+
+class transmission_cache():
+  """Memoized Landauer transmission of a heterostructure as a function
+  of the energy, reused by the current and thermoelectric integrals"""
+  def __init__(self,ht,delta=None):
+    if delta is None: delta = ht.delta # own delta
+    self.ht = ht # heterostructure
+    self.delta = delta # analytic continuation
+    self.fingerprint = heterostructure_hash(ht) # hash of the matrices
+    self.values = dict() # transmission for each energy
+    self.sweeper = None # workers kept between calls
+  def start(self):
+    """Fork the workers once, to be reused by the following calls"""
+    import parallel
+    f = lambda ht,es: landauer(ht,energy=es,delta=self.delta)
+    self.sweeper = parallel.sweeper(f,self.ht) 
+  def stop(self):
+    """Kill the workers"""
+    if self.sweeper is not None: self.sweeper.close()
+    self.sweeper = None
+  def get(self,energies):
+    """Return the transmission for a list of energies, computing
+    together (and in parallel) only the ones not present"""
+    keys = [round(float(e),12) for e in energies] # rounded energies
+    missing = sorted(set([k for k in keys if k not in self.values]))
+    if len(missing)>0: # compute the missing ones
+      if self.sweeper is None: # workers only for this call
+        self.start()
+        try: ts = self.sweeper.chunks(missing)
+        finally: self.stop()
+      else: ts = self.sweeper.chunks(missing) # reuse the workers
+      for (k,t) in zip(missing,ts): self.values[k] = t # store
+    return np.array([self.values[k] for k in keys])
+
+
+
+def get_transmission_cache(ht,delta=None):
+  """Return the transmission cache of a heterostructure, creating a new
+  one if there is none or if the matrices have changed"""
+  if delta is None: delta = ht.delta # own delta
+  tc = getattr(ht,"transmission_cache",None) # current cache
+  if tc is None or tc.delta!=delta or tc.fingerprint!=heterostructure_hash(ht):
+    tc = transmission_cache(ht,delta=delta) # new cache
+    ht.transmission_cache = tc # store
+  return tc
+
+
+
+def window_integral(fs,emin,emax,error=1e-4):
+  """Adaptive integral of a function in [emin,emax], with panels aligned
+  to a dyadic energy grid, so that most of the energies are shared
+  between windows. Returns the integral and an estimate of the error"""
+  from integration import batch_simpson
+  h = 2.**np.floor(np.log2((emax-emin)/8.)) # spacing of the grid
+  a,b = np.ceil(emin/h)*h,np.floor(emax/h)*h # aligned part
+  out,err = 0.,0. # initialize
+  if b<=a: pieces = [(emin,emax,2)] # too small, single interval
+  else: pieces = [(emin,a,2),(a,b,int(round((b-a)/h))),(b,emax,2)]
+  for (x0,x1,n) in pieces: # loop over pieces
+    if x1<=x0: continue # empty
+    eps = error*(x1-x0)/(emax-emin) # fraction of the error
+    o,e,ne = batch_simpson(fs,xlim=[x0,x1],eps=eps,ninit=n) # integrate
+    out,err = out + o,err + e # add contribution
+  return out,err
+
+
+
+def current(ht,bias=0.0,temperature=0.0,delta=None,error=1e-4):
+  """Current I = int T(E) [f_L(E) - f_R(E)] dE, with chemical potentials
+  bias/2 and -bias/2 in the left and right leads, in units of e/h.
+  T(E) is sampled adaptively and kept in the transmission cache of the
+  heterostructure, so it is reused for other biases and temperatures.
+  Returns the current and an estimate of the integration error"""
+  if ht.has_eh: raise # not implemented
+  if bias==0.: return 0.0,0.0 # nothing to do
+  tc = get_transmission_cache(ht,delta=delta) # transmission cache
+  mul,mur = bias/2.,-bias/2. # chemical potentials
+  w = 20.*temperature # width of the thermal tails
+  emin,emax = min([mul,mur])-w,max([mul,mur])+w # window
+  if temperature==0.: # window is a step, integrate only inside
+    fs = lambda es: tc.get(es)*np.sign(bias) 
+  else: # Fermi window
+    fs = lambda es: tc.get(es)*(fermi(es,mul,temperature) - 
+                                  fermi(es,mur,temperature))
+  tc.start() # workers shared by all the levels
+  try: return window_integral(fs,emin,emax,error=error)
+  finally: tc.stop() # kill the workers
+
+
+
+def thermoelectric(ht,temperature=0.01,mu=0.0,delta=None,error=1e-4):
+  """Linear response thermoelectric coefficients at chemical potential
+  mu, using L_n = int T(E) (E-mu)^n (-df/dE) dE, in units e=h=k_B=1.
+  Returns the conductance G = L_0, the Seebeck coefficient
+  S = -L_1/(temperature L_0), the electronic thermal conductance
+  K = (L_2 - L_1^2/L_0)/temperature, and estimates of the errors
+  of L_0, L_1 and L_2"""
+  if ht.has_eh: raise # not implemented
+  if temperature<=0.: raise # only finite temperature
+  tc = get_transmission_cache(ht,delta=delta) # transmission cache
+  kt = temperature # thermal energy
+  def fs(es): # integrands for L_0, L_1/kt and L_2/kt^2
+    x = (np.array(es)-mu)/kt # reduced energies
+    t = tc.get(es)/(4.*kt*np.cosh(x/2.)**2) # T(E) (-df/dE)
+    return np.array([t,t*x,t*x*x]).T
+  tc.start() # workers shared by all the levels
+  try: ls,err = window_integral(fs,mu-20.*kt,mu+20.*kt,error=error)
+  finally: tc.stop() # kill the workers
+  (l0,l1,l2) = ls[0],kt*ls[1],kt*kt*ls[2] # Onsager coefficients
+  G = l0 # conductance
+  S = -l1/(temperature*l0) # Seebeck coefficient
+  K = (l2 - l1*l1/l0)/temperature # thermal conductance
+  return G,S,K,err*np.array([1.,kt,kt*kt])
+
+
+
+def rgf_columns(m):
+  """Recursive Green function algorithm for the first and last columns
+  of blocks of the inverse of a block tridiagonal matrix m = E - H - Sigma,
+  given as a list of lists. Returns the lists G_i1 and G_iN, using the
+  left and right connected Green functions, without forming the full G"""
+  nb = len(m) # number of blocks
+  gls = [None for i in range(nb)] # left connected green functions
+  grs = [None for i in range(nb)] # right connected green functions
+  gls[0] = np.linalg.inv(dense_block(m[0][0])) # first one
+  for i in range(1,nb): # sweep to the right
+    d = dense_block(m[i][i-1]).dot(gls[i-1]).dot(dense_block(m[i-1][i]))
+    gls[i] = np.linalg.inv(dense_block(m[i][i]) - d) # Dyson
+  grs[nb-1] = np.linalg.inv(dense_block(m[nb-1][nb-1])) # last one
+  for i in range(nb-2,-1,-1): # sweep to the left
+    d = dense_block(m[i][i+1]).dot(grs[i+1]).dot(dense_block(m[i+1][i]))
+    grs[i] = np.linalg.inv(dense_block(m[i][i]) - d) # Dyson
+  g1 = [None for i in range(nb)] # blocks G_i1
+  gn = [None for i in range(nb)] # blocks G_iN
+  if nb==1: g1[0] = gls[0] # single block
+  else: # full G_11
+    d = dense_block(m[0][1]).dot(grs[1]).dot(dense_block(m[1][0]))
+    g1[0] = np.linalg.inv(dense_block(m[0][0]) - d) 
+  for i in range(1,nb): g1[i] = -grs[i].dot(dense_block(m[i][i-1])).dot(g1[i-1])
+  gn[nb-1] = gls[nb-1] # full G_NN
+  for i in range(nb-2,-1,-1): 
+    gn[i] = -gls[i].dot(dense_block(m[i][i+1])).dot(gn[i+1])
+  return g1,gn
+
+
+
+class transport_map():
+  """Spatially resolved transport in the central part. bonds is an
+  array with the pairs of central sites (i,j) coupled by the Hamiltonian,
+  current[l] the bond current i -> j for electrons injected from lead l
+  (0 left, 1 right) and ldos[l] the local density of states injected
+  by lead l"""
+  def __init__(self):
+    self.energy = 0.0 # energy
+    self.transmission = 0.0 # Landauer transmission
+    self.bonds = np.zeros((0,2),dtype=int) # pairs of sites
+    self.current = np.zeros((2,0)) # current in each bond
+    self.ldos = np.zeros((2,0)) # injected local density of states
+  def save(self,output_file="TRANSPORT_MAP.npz"):
+    """Save all the arrays in a single file"""
+    np.savez(output_file,energy=self.energy,bonds=self.bonds,
+               transmission=self.transmission,current=self.current,
+               ldos=self.ldos)
+
+
+
+def local_transport(ht,energy=0.0,delta=None):
+  """Bond currents J_ij = 2 Im(H_ji G^n_ij) and injected local density of
+  states of each lead, with G^n = G Gamma G^dagger, obtained together with
+  the transmission from the first and last block columns of G.
+  Returns a transport_map object"""
+  if delta is None: delta = ht.delta # own delta
+  ht = partition(ht) # block tridiagonal form, if possible
+  selfl = ht.get_selfenergy(energy,lead=0,delta=delta,pristine=False)
+  selfr = ht.get_selfenergy(energy,lead=1,delta=delta,pristine=False)
+  gammas = [np.asarray(1j*(s-s.H)) for s in [selfl,selfr]] # gammas
+  if ht.block_diagonal: hc = ht.central_intra # list of blocks
+  else: hc = [[ht.central_intra]] # single block
+  m = effective_tridiagonal_hamiltonian(hc,selfl,selfr,
+                                  energy=energy,delta=delta) # E - H - Sigma
+  gcols = rgf_columns(m) # first and last block columns
+  nb = len(hc) # number of blocks
+  ns = [dense_block(hc[i][i]).shape[0] for i in range(nb)] # block sizes
+  offsets = np.concatenate([[0],np.cumsum(ns)]) # first site of each block
+  out = transport_map() # output object
+  out.energy = energy
+  gn1 = gcols[0][nb-1] # G_N1
+  out.transmission = np.trace(gammas[1].dot(gn1).dot(gammas[0]).dot(
+                               gn1.conj().T)).real # Landauer formula
+  # pairs of blocks with bonds, and the blocks of the Hamiltonian
+  pairs = [(i,i) for i in range(nb)] + [(i,i+1) for i in range(nb-1)]
+  bonds = [] # list with the bonds
+  hij = [] # list with the hoppings
+  for (i,j) in pairs:
+    c = coo_matrix(hc[i][j]) # block of the Hamiltonian
+    keep = np.abs(c.data)>0. # nonzero hoppings
+    if i==j: keep = keep*(c.row<c.col) # each bond only once
+    bonds.append(np.array([c.row[keep],c.col[keep],
+                  np.repeat(i,np.sum(keep)),np.repeat(j,np.sum(keep))]).T)
+    hij.append(c.data[keep])
+  bonds = np.concatenate(bonds).astype(int) # (site, site, block, block)
+  hij = np.concatenate(hij)
+  out.current = np.zeros((2,len(bonds))) # initialize
+  out.ldos = np.zeros((2,offsets[-1])) # initialize
+  for l in range(2): # loop over leads
+    gc = gcols[l] # block column of G connected to this lead
+    gg = [g.dot(gammas[l]) for g in gc] # G Gamma
+    for i in range(nb): # diagonal of G^n
+      out.ldos[l,offsets[i]:offsets[i+1]] = np.sum(gg[i]*gc[i].conj(),
+                                                   axis=1).real/(2*np.pi)
+    for (i,j) in pairs: # bonds between blocks i and j
+      ib = (bonds[:,2]==i)*(bonds[:,3]==j) # bonds in this pair of blocks
+      gnji = gg[j].dot(gc[i].conj().T) # block G^n_ji
+      b = bonds[ib] # bonds
+      out.current[l,ib] = -2*(hij[ib]*gnji[b[:,1],b[:,0]]).imag
+  sites = np.array([bonds[:,0]+offsets[bonds[:,2]],
+                    bonds[:,1]+offsets[bonds[:,3]]]).T # global indexes
+  if hasattr(ht,"central_order"): # go back to the original ordering
+    sites = ht.central_order[sites]
+    out.ldos[:,ht.central_order] = out.ldos.copy()
+  out.bonds = sites # store
+  return out
+
+
+
+def transmission_vs_length(ht_builder,lengths,energy=0.0,delta=None):
+  """Landauer transmission for several lengths of the central part,
+  obtained in a single recursive sweep. ht_builder is a function that
+  returns a block diagonal heterostructure with a certain number of
+  central cells, whose first cells must not depend on the total length.
+  The left connected Green function of the previous length is reused,
+  so the cost is linear in the maximum length"""
+  lengths = [int(l) for l in lengths] # number of cells
+  if len(lengths)==0 or min(lengths)<1: # at least one central cell
+    raise ValueError("Lengths must be positive integers")
+  ht = ht_builder(max(lengths)) # heterostructure with the largest length
+  if not ht.block_diagonal: # single cell, nothing to reuse
+    return [landauer(ht_builder(l),energy=energy) for l in lengths]
+  if delta is None: delta = ht.delta # use the own delta
+  selfl = ht.get_selfenergy(energy,lead=0,delta=delta,pristine=False)
+  selfr = ht.get_selfenergy(energy,lead=1,delta=delta,pristine=False)
+  gammal = np.asarray(1j*(selfl-selfl.H)) # left gamma
+  gammar = np.asarray(1j*(selfr-selfr.H)) # right gamma
+  selfl = np.asarray(selfl) # as array
+  selfr = np.asarray(selfr) # as array
+  hc = ht.central_intra # list with the central blocks
+  ts = dict() # transmission for each length
+  ls = set(lengths) # lengths to compute
+  for i in range(max(lengths)): # grow the central part cell by cell
+    hii = dense_block(hc[i][i]) # onsite block
+    mii = (energy+1j*delta)*np.identity(hii.shape[0]) - hii # E - H
+    if i==0: mii = mii - selfl # first cell is coupled to the left lead
+    else: # couple to the left connected green function
+      u = -dense_block(hc[i-1][i]) # coupling i-1 -> i
+      d = -dense_block(hc[i][i-1]) # coupling i -> i-1
+      mii = mii - d.dot(gl).dot(u) # Dyson equation
+      dgn1 = d.dot(gn1) # auxiliary product
+    if (i+1) in ls: # attach the right lead to this cell
+      gc = np.linalg.inv(mii - selfr) # last diagonal block
+      if i==0: gcn1 = gc # single cell
+      else: gcn1 = -gc.dot(dgn1) # G_N1
+      t = gammar.dot(gcn1).dot(gammal).dot(gcn1.conj().T) # Landauer
+      ts[i+1] = np.trace(t).real # store
+    gl = np.linalg.inv(mii) # left connected green function
+    if i==0: gn1 = gl # G_11
+    else: gn1 = -gl.dot(dgn1) # G_i1
+  return [ts[l] for l in lengths] # return transmissions
+
+
+def dense_block(m):
+  """Return a block as a dense array"""
+  from scipy.sparse import issparse
+  if issparse(m): return m.toarray()
+  return np.asarray(m)
+
+
 
 def build(h1,h2,central=None,**kwargs):
   """Create a heterostructure, works also for 2d"""
@@ -1030,12 +1677,77 @@ def build(h1,h2,central=None,**kwargs):
       return create_leads_and_central_list(h1p,h2p,centralp) # standard way
     hout = heterostructure() # create
     hout.dimensionality = 2 # two dimensional
-    hout.generate = fun # function that generates the heterostructure
+    hout.generate = fourier_generator(fun) # generates the heterostructure
     return hout # function that return a heterostructure
   else: raise
 
 
 
+def load(input_path="heterostructure.qtp",mmap=True,green=True):
+  """Load a heterostructure saved in binary form"""
+  import storage
+  return storage.load_heterostructure(input_path,mmap=mmap,green=green)
+
+
+
+def fourier_generator(fun,nh=1,ktest=0.37,tol=1e-8):
+  """Given a function k -> heterostructure, whose matrices only contain
+  harmonics exp(i 2 pi n k) with |n|<=nh, return an equivalent function
+  that builds the heterostructure from precomputed Fourier components.
+  The components are computed in the first call, and checked against
+  fun at ktest, raising ValueError if there are more harmonics"""
+  from copy import copy
+  ns = range(-nh,nh+1) # harmonics
+  ks = [float(j)/len(ns) for j in range(len(ns))] # sampling points
+  names = ["right_intra","right_inter","left_intra","left_inter",
+             "right_coupling","left_coupling"] # matrices of the leads
+  fc = dict() # dictionary with the components, filled when needed
+  def components(ms): # Fourier components of a matrix
+    if ms[0] is None: return None
+    cs = [] # list with the components
+    for n in ns:
+      c = ms[0]*np.exp(-2j*np.pi*n*ks[0]) # first term
+      for (m,k) in zip(ms[1:],ks[1:]): c = c + m*np.exp(-2j*np.pi*n*k)
+      cs.append(c/len(ks)) # store
+    return cs
+  def evaluate(cs,k): # evaluate at a certain k
+    if cs is None: return None
+    m = cs[0]*np.exp(2j*np.pi*ns[0]*k) # first term
+    for (c,n) in zip(cs[1:],ns[1:]): m = m + c*np.exp(2j*np.pi*n*k)
+    return m
+  def matrices(ht): # list with all the matrices
+    ms = [getattr(ht,name) for name in names] # matrices of the leads
+    if ht.block_diagonal: # list of lists
+      for row in ht.central_intra: ms += row
+    else: ms.append(ht.central_intra)
+    return ms
+  def setup(): # compute the Fourier components
+    hts = [fun(k) for k in ks] # heterostructures at the sampling points
+    for name in names: fc[name] = components([getattr(h,name) for h in hts])
+    if hts[0].block_diagonal: # list of lists
+      nb = len(hts[0].central_intra) # number of blocks
+      fc["central"] = [[components([h.central_intra[i][j] for h in hts]) 
+                 for j in range(nb)] for i in range(nb)]
+    else: fc["central"] = components([h.central_intra for h in hts])
+    fc["template"] = hts[0] # heterostructure to copy
+    for (m0,m1) in zip(matrices(fun(ktest)),matrices(fun_fourier(ktest))): 
+      if m0 is None: continue
+      if np.max(np.abs(dense_block(m0-m1)))>tol: # different matrices
+        raise ValueError("Hoppings beyond "+str(nh)+
+                           " neighboring cells, increase nh")
+  def fun_fourier(k):
+    if len(fc)==0: setup() # first call, compute the components
+    ht = copy(fc["template"]) # shallow copy, the matrices are replaced
+    for name in names: setattr(ht,name,evaluate(fc[name],k))
+    if ht.block_diagonal: # list of lists
+      ht.central_intra = [[evaluate(c,k) for c in row] 
+                             for row in fc["central"]]
+    else: ht.central_intra = evaluate(fc["central"],k)
+    return ht
+  return fun_fourier
+
+
+
 def get_full_sparse():
   """Return a heterostrure in full sparse form"""
   
@@ -1,9 +1,18 @@
-
 import numpy as np
 
-def integrate_matrix(f,xlim=[0.,1.],eps=0.1,only_imag=False):
-  """ Integrates a matrix, the measure is the maximun value of the matrix"""
-  return adaptive_simpsons_rule(f,xlim[0],xlim[1],eps,only_imag=only_imag)
+def integrate_matrix(f,xlim=[0.,1.],eps=0.1,only_imag=False,fbatch=None,
+                       info=False,ninit=4):
+  """ Integrates a matrix, the measure is the maximun value of the matrix.
+  The function is never evaluated twice at the same point, fbatch
+  can be provided to evaluate a list of points at once. If info is True,
+  returns the integral, the error and the number of evaluations"""
+  if fbatch is None: fbatch = lambda xs: [f(x) for x in xs] # one by one
+  if only_imag: measure = lambda d: np.max(np.abs(np.imag(d))) # imaginary
+  else: measure = None # default measure
+  out = batch_simpson(fbatch,xlim=xlim,eps=eps,ninit=ninit,smooth=True,
+                        measure=measure)
+  if info: return out # integral, error and evaluations
+  else: return out[0] # only the integral
 
 
 
@@ -30,7 +39,8 @@ def recursive_asr_imag(f,a,b,eps,whole):
     right = simpsons_rule(f,c,b)
     if np.max(np.abs(np.imag(left + right - whole))) <= 15*eps:
         return left + right + (left + right - whole)/15.0
-    return recursive_asr(f,a,c,eps/2.0,left) + recursive_asr(f,c,b,eps/2.0,right)
+    return (recursive_asr_imag(f,a,c,eps/2.0,left) + 
+              recursive_asr_imag(f,c,b,eps/2.0,right))
 
 
 
@@ -72,3 +82,52 @@ def adaptive_simpsons_rule(f,a,b,eps,only_imag=False):
 
 
 
+
+
+
+
+def batch_simpson(fs,xlim=[0.,1.],eps=1e-4,ninit=16,maxdepth=20,
+                    smooth=False,measure=None):
+  """Adaptive Simpson's rule for a function, where fs evaluates
+  the function for a list of points at once (e.g. in parallel). All the
+  panels that need refinement are split in the same step, so that the new
+  points are evaluated together. The function may return arrays, and
+  then the error is the maximum over the components, or the one given
+  by measure. If smooth is True, the usual 1/15 error factor and the
+  Richardson correction are used. Returns the
+  integral, an estimate of the error and the number of evaluations"""
+  if measure is None: measure = lambda d: np.max(np.abs(d)) # default
+  a,b = float(xlim[0]),float(xlim[1]) # limits
+  values = dict() # memoized values of the function
+  def evaluate(xs): # evaluate the points not computed so far
+    xs = [x for x in set(xs) if x not in values]
+    if len(xs)==0: return
+    for (x,y) in zip(xs,fs(xs)): values[x] = y
+  def rule(x0,x1): # Simpson's rule with stored values
+    return abs(x1-x0)/6.*(values[x0]+4.*values[(x0+x1)/2.]+values[x1])
+  xs = [a+(b-a)*i/float(ninit) for i in range(ninit+1)] # boundaries
+  todo = [(xs[i],xs[i+1],0) for i in range(ninit)] # initial panels
+  evaluate(xs + [(x0+x1)/2. for (x0,x1,d) in todo]) # initial points
+  todo = [(x0,x1,rule(x0,x1),d) for (x0,x1,d) in todo] 
+  out,err = 0.,0. # integral and error
+  while len(todo)>0: # loop until all the panels converge
+    qs = [] # quarter points
+    for (x0,x1,s,d) in todo: 
+      c = (x0+x1)/2.
+      qs += [(x0+c)/2.,(c+x1)/2.]
+    evaluate(qs) # evaluate all the new points together
+    new = [] # new panels
+    for (x0,x1,s,d) in todo: 
+      c = (x0+x1)/2.
+      l,r = rule(x0,c),rule(c,x1) # left and right halves
+      # error estimate, by default without the factor 1/15 that only 
+      # holds for smooth functions, so that kinks and steps are refined
+      e = measure(l+r-s) 
+      if smooth: e = e/15. # smooth function
+      if e<=eps*abs(x1-x0)/abs(b-a) or d>=maxdepth: # converged
+        out += l + r # add contribution
+        if smooth: out += (l+r-s)/15. # Richardson correction
+        err += e # add to the error
+      else: new += [(x0,c,l,d+1),(c,x1,r,d+1)] # split the panel
+    todo = new # new panels
+  return out,err,len(values)
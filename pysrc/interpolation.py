@@ -42,3 +42,114 @@ def interpolator2d(x,y,z):
   return f
 
 
+
+
+
+
+class chebyshev_matrix():
+  """Piecewise Chebyshev expansion of a matrix valued function of a
+  real variable, with a certain error tolerance"""
+  def __init__(self,bounds=None,coefficients=None,tol=0.0):
+    self.bounds = bounds # breakpoints of the intervals
+    self.coefficients = coefficients # (intervals,degree+1,n,m) array
+    self.tol = tol # error tolerance
+  def contains(self,x):
+    """Check if a point is inside the interpolation window"""
+    return self.bounds[0]<=x<=self.bounds[-1]
+  def evaluate(self,xs):
+    """Evaluate the function for a list of points, returns an array
+    (len(xs),n,m), that is zero outside the window"""
+    xs = np.array(xs,dtype=float).reshape(-1) # points
+    (ni,nc,n,m) = self.coefficients.shape # dimensions
+    out = np.zeros((len(xs),n,m),dtype=np.complex128) # output
+    ii = np.searchsorted(self.bounds,xs,side="right") - 1 # intervals
+    ii[xs==self.bounds[-1]] = ni - 1 # last point belongs to the last one
+    for i in np.unique(ii): # loop over the intervals
+      if i<0 or i>=ni: continue # outside the window
+      js = np.where(ii==i)[0] # points in this interval
+      a,b = self.bounds[i],self.bounds[i+1] # limits
+      t = np.arccos(np.clip((2*xs[js]-a-b)/(b-a),-1.,1.)) # angles
+      ts = np.cos(np.outer(t,np.arange(nc))) # Chebyshev polynomials
+      out[js] = np.tensordot(ts,self.coefficients[i],axes=(1,0)) # sum
+    return out
+  def __call__(self,x):
+    """Evaluate the function at a certain point"""
+    return np.matrix(self.evaluate([x])[0])
+
+
+
+def chebyshev_nodes(a,b,degree):
+  """Chebyshev nodes of an interval"""
+  t = np.pi*(np.arange(degree+1)+0.5)/(degree+1) # angles
+  return (a+b)/2. + (b-a)/2.*np.cos(t)
+
+
+
+def chebyshev_test_points(a,b,degree):
+  """Points in between the Chebyshev nodes of an interval"""
+  t = np.pi*np.arange(1,degree+1)/(degree+1) # angles
+  return (a+b)/2. + (b-a)/2.*np.cos(t)
+
+
+
+def chebyshev_fit(fs,xlim=[-4.,4.],tol=1e-4,degree=16,ninit=8,maxdepth=30,
+                    safety=10.):
+  """Return a piecewise Chebyshev expansion of a matrix valued function,
+  where fs evaluates the function for a list of points at once. The
+  intervals whose error at the points in between the nodes is larger
+  than tol/safety are split in two, so that the error in the whole
+  interval stays below tol, and all the new intervals are evaluated
+  together in a single call"""
+  nc = degree + 1 # number of coefficients
+  t = np.pi*(np.arange(nc)+0.5)/nc # angles of the nodes
+  dct = 2./nc*np.cos(np.outer(np.arange(nc),t)) # nodes to coefficients
+  dct[0,:] /= 2.
+  tt = np.pi*np.arange(1,nc)/nc # angles of the test points
+  ttest = np.cos(np.outer(tt,np.arange(nc))) # coefficients to test points
+  x0 = np.linspace(xlim[0],xlim[1],ninit+1) # initial breakpoints
+  todo = [(x0[i],x0[i+1],0) for i in range(ninit)] # intervals to fit
+  done = [] # converged intervals
+  while len(todo)>0: # loop until all the intervals converge
+    xs = [np.concatenate([chebyshev_nodes(a,b,degree),
+              chebyshev_test_points(a,b,degree)]) for (a,b,d) in todo]
+    ms = np.array(fs(np.concatenate(xs)),dtype=np.complex128) # evaluate
+    ms = ms.reshape((len(todo),2*nc-1)+ms.shape[1:]) # split by interval
+    new = [] # intervals to split
+    for ((a,b,d),m) in zip(todo,ms): 
+      c = np.tensordot(dct,m[0:nc],axes=(1,0)) # coefficients
+      error = np.max(np.abs(np.tensordot(ttest,c,axes=(1,0)) - m[nc:]))
+      if error<tol/safety: done.append((a,b,c)) # converged
+      elif d>=maxdepth: # too many splits, keep it anyway
+        print("Warning, Chebyshev fit not converged in",(a,b),
+                "with error",error)
+        done.append((a,b,c))
+      else: new += [(a,(a+b)/2.,d+1),((a+b)/2.,b,d+1)] # split
+    todo = new
+  done.sort(key=lambda x: x[0]) # sort the intervals
+  bounds = np.array([x[0] for x in done]+[done[-1][1]]) # breakpoints
+  cs = np.array([x[2] for x in done]) # coefficients
+  return chebyshev_matrix(bounds=bounds,coefficients=cs,tol=tol)
+
+
+
+def save_chebyshev(fs,output_file,**kwargs):
+  """Save a list of piecewise Chebyshev expansions in a file, together
+  with additional parameters"""
+  for (i,f) in enumerate(fs): # loop over the functions
+    kwargs["bounds_"+str(i)] = f.bounds
+    kwargs["coefficients_"+str(i)] = f.coefficients
+    kwargs["tol_"+str(i)] = f.tol
+  np.savez(output_file,number=len(fs),**kwargs)
+
+
+
+def load_chebyshev(input_file):
+  """Load a list of piecewise Chebyshev expansions from a file, returns
+  the list and a dictionary with the additional parameters"""
+  d = dict(np.load(input_file)) # read all the arrays
+  fs = [] # list of functions
+  for i in range(int(d.pop("number"))): # loop over the functions
+    fs.append(chebyshev_matrix(bounds=d.pop("bounds_"+str(i)),
+                      coefficients=d.pop("coefficients_"+str(i)),
+                      tol=float(d.pop("tol_"+str(i)))))
+  return fs,d
@@ -120,49 +120,130 @@ def current(data,voltage,n=3):
 
 
 
-def calculate_current(ht,v=0.01,delta=0.01):
-  """Calculate the current using aheterostructure"""
-  if ht.block_diagonal: raise # not implemented
+def nambu_tauz(n):
+  """Nambu tauz for the ordering used in the Hamiltonians, two electron
+  components followed by two hole components for each site"""
+  from scipy.sparse import diags
+  return diags(np.where(np.arange(n)%4<2,1.,-1.),format="csc")
+
+
+
+def eh_projection(m,i=0,j=0):
+  """Project the rows of a matrix on electrons (0) or holes (1), and
+  the columns on electrons (0) or holes (1)"""
+  from scipy.sparse import diags
+  pr = (np.arange(m.shape[0])%4<2)==(i==0) # rows to keep
+  pc = (np.arange(m.shape[1])%4<2)==(j==0) # columns to keep
+  return diags(pr*1.,format="csc")*csc_matrix(m)*diags(pc*1.,format="csc")
+
+
+
+def floquet_integrand(data,e,omega,n):
+  """Contribution to the DC current of the energy e, using 2n+1
+  harmonics. The Floquet problem is kept sparse and only the block of
+  the retarded Green function in the sites of the leads is computed,
+  with a single sparse factorization"""
+  from scipy.sparse import kron,diags,identity
+  from scipy.sparse.linalg import splu
+  nh = 2*n + 1 # number of harmonics
+  N = data.ham.shape[0] # dimension of the static problem
+  ms = np.arange(-n,n+1) # harmonics
+  hf = kron(identity(nh),data.ham) - kron(diags(ms*omega),identity(N))
+  if nh>1: # coupling between harmonics
+    hf = hf + kron(diags(np.ones(nh-1),1),data.tfreq)
+    hf = hf + kron(diags(np.ones(nh-1),-1),data.tfreq.H)
+  sites = np.concatenate([data.il,data.ir]) # sites of the leads
+  ns = len(sites) # number of sites of the leads
+  P = np.concatenate([m*N + sites for m in range(nh)]) # Floquet indexes
+  np_ = len(P) # dimension of the lead subspace
+  sr = np.zeros((np_,np_),dtype=np.complex128) # retarded selfenergy
+  sless = np.zeros((np_,np_),dtype=np.complex128) # lesser selfenergy
+  sla = np.zeros((np_,np_),dtype=np.complex128) # advanced, left lead
+  sll = np.zeros((np_,np_),dtype=np.complex128) # lesser, left lead
+  nl = len(data.il) # sites of the left lead
+  for (k,m) in enumerate(ms): # loop over harmonics
+    ebar = e + m*omega # Floquet energy
+    l = np.asarray(data.self_l(ebar)) # left selfenergy
+    r = np.asarray(data.self_r(ebar)) # right selfenergy
+    il = slice(k*ns,k*ns+nl) # left lead in this harmonic
+    ir = slice(k*ns+nl,(k+1)*ns) # right lead in this harmonic
+    sr[il,il],sr[ir,ir] = l,r
+    sla[il,il] = l.conj().T # advanced selfenergy of the left lead
+    if ebar>=0.: # lesser selfenergies
+      sll[il,il] = -(l-l.conj().T) 
+      sless[il,il] = -(l-l.conj().T) 
+      sless[ir,ir] = -(r-r.conj().T) 
+  rows = np.repeat(P,np_) # embed the selfenergy in the full space
+  cols = np.tile(P,np_)
+  sfull = csc_matrix((sr.reshape(-1),(rows,cols)),shape=hf.shape)
+  m = (e+1j*data.delta)*identity(hf.shape[0]) - hf - sfull # E - H - Sigma
+  lu = splu(csc_matrix(m,dtype=np.complex128)) # factorize
+  rhs = np.zeros((hf.shape[0],np_),dtype=np.complex128) # unit vectors
+  rhs[P,np.arange(np_)] = 1.0
+  g = lu.solve(rhs)[P,:] # retarded Green function in the leads
+  tz = np.tile(data.tauz.diagonal()[sites],nh) # tauz in the leads
+  gless = g.dot(sless).dot(g.conj().T) # lesser Green function
+  val = np.trace(g.dot(sll*tz)) + np.trace(gless.dot(sla*tz)) # current
+  return val.real
+
+
+
+def floquet_current(data,voltage,tol=1e-3,nmin=1,nmax=200,error=1e-4):
+  """DC current at a certain voltage, integrating over a period of
+  energies. The number of harmonics is increased for each energy until
+  the change of the integrand is below tol (relative), and the last
+  converged number is used as the starting point of the next energy"""
+  from integration import batch_simpson
+  omega = voltage # frequency
+  if omega==0.: return 0.0 # no current
+  nh = [nmin] # current number of harmonics
+  def convfun(e): # integrand with converged harmonics
+    n = nh[0] # start with the last value
+    r0 = floquet_integrand(data,e,omega,n)
+    while n<nmax: # increase the number of harmonics
+      r1 = floquet_integrand(data,e,omega,n+2)
+      if np.abs(r1-r0)<=tol*(np.abs(r0)+np.abs(r1))/2. + error*1e-3: break
+      n,r0 = n+2,r1 # update
+    nh[0] = n # store for the next energy
+    return r0
+  fs = lambda es: [convfun(e) for e in es] # several energies
+  return batch_simpson(fs,xlim=[0.,omega],eps=error)[0]
+
+
+
+def calculate_current(ht,v=0.01,delta=0.01,tol=1e-3,error=1e-4):
+  """Calculate the current using a heterostructure, keeping the
+  Floquet problem sparse"""
+  if ht.block_diagonal: # put in full form
+    from heterostructures import block2full
+    ht = block2full(ht,sparse=True)
   ###########################################################
   # time independent part of central Hamiltonian
   ham = [[None for i in range(3)] for j in range(3)]  
-  ham[0][0] = ht.left_intra
-  ham[1][1] = ht.central_intra
-  ham[2][2] = ht.right_intra
-  ham = bmat(ham).todense() # dense matrix
-  # get the Nambu tauz
-  from hamiltonians import get_nambu_tauz
-  from hamiltonians import project_electrons as eproj
-  from hamiltonians import project_holes as hproj
-  tauz = get_nambu_tauz(ham,has_eh=True) # Nambu tauz
+  ham[0][0] = csc_matrix(ht.left_intra)
+  ham[1][1] = csc_matrix(ht.central_intra)
+  ham[2][2] = csc_matrix(ht.right_intra)
+  ham = bmat(ham).tocsc() # sparse matrix
+  tauz = nambu_tauz(ham.shape[0]) # Nambu tauz
   # now calculate the time dependent coupling (positive frequency)
   tfreq = [[None for i in range(3)] for j in range(3)]  
-  tfreq[0][0] = ht.left_intra*0.0
-  tfreq[1][1] = ht.central_intra*0.0
-  tfreq[2][2] = ht.right_intra*0.0
-  tfreq[0][1] = eproj(ht.left_coupling.H) # project on electrons
-  tfreq[1][0] = hproj(ht.left_coupling) # project on holes
-  tfreq[1][2] = eproj(ht.right_coupling) # project on electrons
-  tfreq[2][1] = hproj(ht.right_coupling.H) # project on holes
-  tfreq = bmat(tfreq)
+  tfreq[0][0] = csc_matrix(ht.left_intra.shape)
+  tfreq[1][1] = csc_matrix(ht.central_intra.shape)
+  tfreq[2][2] = csc_matrix(ht.right_intra.shape)
+  tfreq[0][1] = eh_projection(ht.left_coupling.H,0,0) # on electrons
+  tfreq[1][0] = eh_projection(ht.left_coupling,1,1) # on holes
+  tfreq[1][2] = eh_projection(ht.right_coupling,0,0) # on electrons
+  tfreq[2][1] = eh_projection(ht.right_coupling.H,1,1) # on holes
+  tfreq = bmat(tfreq).tocsc()
   class Data(): pass
   data =  Data() # create data
   data.tauz = tauz
   data.ham = ham
   data.tfreq = tfreq
-  def m2block(m,i=0):
-    out = [[None for i in range(3)] for j in range(3)]  
-    out[0][0] = np.zeros(ht.left_intra.shape)
-    out[1][1] = np.zeros(ht.central_intra.shape)
-    out[2][2] = np.zeros(ht.right_intra.shape)
-    out[i][i] = m
-    return bmat(out)
-  lgen = lambda e: ht.get_selfenergy(e,lead=0,pristine=True)
-  rgen = lambda e: ht.get_selfenergy(e,lead=1,pristine=True)
-  data.self_l = lambda e: m2block(lgen(e),i=0)
-  data.self_r = lambda e: m2block(rgen(e),i=2)
+  nl,nr = ht.left_intra.shape[0],ht.right_intra.shape[0] # leads
+  data.il = np.arange(nl) # sites of the left lead
+  data.ir = np.arange(ham.shape[0]-nr,ham.shape[0]) # sites of the right
+  data.self_l = lambda e: ht.get_selfenergy(e,lead=0,pristine=True)
+  data.self_r = lambda e: ht.get_selfenergy(e,lead=1,pristine=True)
   data.delta = delta
-  return current(data,v) # return current
-
-
-
+  return floquet_current(data,v,tol=tol,error=error) # return current
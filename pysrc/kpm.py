@@ -3,9 +3,11 @@ from __future__ import print_function,division
 import scipy.sparse.linalg as lg
 from scipy.sparse import csc_matrix as csc
 import numpy.random as rand
-from scipy.sparse import coo_matrix,csc_matrix,bmat
+from scipy.sparse import coo_matrix,csc_matrix,csr_matrix,bmat,identity
 import numpy as np
 from scipy.signal import hilbert
+try: from scipy.fft import dct # discrete cosine transform
+except: from scipy.fftpack import dct # older scipy
 
 # check that the fortran library exists
 try: 
@@ -15,6 +17,12 @@ except:
   use_fortran = False # use python routines
   print("FORTRAN library not present, using default python one")
 
+try: # in place sparse times dense product
+  from scipy.sparse._sparsetools import csr_matvecs
+except:
+  try: from scipy.sparse.sparsetools import csr_matvecs # older scipy
+  except: csr_matvecs = None # use the usual product
+
 
 
 
@@ -60,6 +68,60 @@ def python_kpm_moments(v,m,n=100):
   return mus
 
 
+def block_moments(m_in,vs,n=100,block=32,columns=False):
+  """Moments of a matrix averaged over the columns of a dense (N,R)
+  array of vectors. The vectors are advanced together, with one sparse
+  times dense product per step performed in preallocated buffers, and
+  the product of two polynomials gives two moments per step (as in
+  python_kpm_moments). Returns 2n moments, or an (R,2n) array with the
+  moments of each vector if columns is True"""
+  m = csr_matrix(m_in) # sparse matrix
+  vs = np.asarray(vs) # dense array
+  if len(vs.shape)==1: vs = vs.reshape((len(vs),1)) # single vector
+  dtype = np.result_type(m.dtype,vs.dtype,np.float64) # real or complex
+  m = csr_matrix(m,dtype=dtype) # same type as the vectors
+  nv = vs.shape[1] # number of vectors
+  if columns: # moments of each vector
+    mus = np.zeros((nv,2*n),dtype=np.complex128) 
+    dot = lambda x,y: np.einsum("ij,ij->j",np.conjugate(x),y) 
+  else: # sum over all the vectors
+    mus = np.zeros((1,2*n),dtype=np.complex128) 
+    dot = np.vdot # single scalar product
+  for i0 in range(0,nv,block): # loop over blocks of vectors
+    a0 = np.array(vs[:,i0:i0+block],dtype=dtype,order="C") # copy
+    if columns: out = mus[i0:i0+block] # moments of this block
+    else: out = mus # all the vectors together
+    a = block_product(m,a0) # vector number 1
+    out[:,0] += dot(a0,a0) # mu0
+    out[:,1] += dot(a,a0) # mu1
+    am = a0 # buffer of the previous vector
+    for i in range(1,n): 
+      out[:,2*i] += 2.*dot(a,a) # product of T_i and T_i
+      am *= -0.5 # minus half the previous vector
+      block_product(m,a,out=am) # add m*a
+      am *= 2. # recursion relation, am contains the new vector
+      out[:,2*i+1] += 2.*dot(am,a) # product of T_(i+1) and T_i
+      (am,a) = (a,am) # swap the buffers
+  mus[:,2::2] -= mus[:,0:1] # from products to moments
+  mus[:,3::2] -= mus[:,1:2] 
+  bound = 1.01*np.abs(mus[:,0:1]) + 1e-10 # moments are bounded by mu0
+  if not np.all(np.abs(mus)<bound): # the recursion has diverged
+    raise ValueError("Spectrum outside (-1,1), increase the KPM scale")
+  if columns: return mus
+  else: return mus[0]/nv # average over vectors
+
+
+
+def block_product(m,a,out=None):
+  """Add the product of a csr matrix and a dense array to out, returns out"""
+  if out is None: out = np.zeros(a.shape,dtype=a.dtype) # new array
+  if csr_matvecs is None: out += m.dot(a) # conventional product
+  else: csr_matvecs(m.shape[0],m.shape[1],a.shape[1],m.indptr,m.indices,
+                      m.data,a.ravel(),out.ravel()) # in place
+  return out
+
+
+
 def python_kpm_moments_clear(v,m,n=100):
   """Python routine to calculate moments"""
   mus = np.array([0.0j for i in range(2*n)]) # empty arrray for the moments
@@ -200,13 +262,159 @@ def local_dos(m_in,i=0,n=200,use_fortran=use_fortran):
 
 
 
-def ldos0d(m_in,i=0,scale=10.,npol=None,ne=500,kernel="jackson"):
+def local_dos_sites(m_in,sites=None,n=200,block=32):
+  """Moments of the local DOS of several sites (all if sites is None)
+  in a single run, propagating blocks of unit vectors. Returns an
+  array with the 2n moments of each site"""
+  m = csr_matrix(m_in) # sparse matrix
+  nd = m.shape[0] # length of the matrix
+  if sites is None: sites = range(nd) # all the sites
+  sites = np.array(sites,dtype=int) # array with the sites
+  mus = np.zeros((len(sites),2*n),dtype=np.complex128) # moments
+  for i0 in range(0,len(sites),block): # loop over blocks of sites
+    ss = sites[i0:i0+block] # sites of this block
+    vs = np.zeros((nd,len(ss))) # unit vectors
+    vs[ss,range(len(ss))] = 1.0 # vector only in site i
+    mus[i0:i0+block] = block_moments(m,vs,n=n,block=block,columns=True)
+  return mus
+
+
+
+def stochastic_local_dos(m_in,n=200,ntries=10,block=32):
+  """Moments of the local DOS of all the sites at once, using vectors
+  with random phases in each site. Returns an array with the 2n
+  moments of each site"""
+  m = csr_matrix(m_in,dtype=np.complex128) # sparse matrix
+  nd = m.shape[0] # length of the matrix
+  mus = np.zeros((nd,2*n),dtype=np.complex128) # moments
+  for i0 in range(0,ntries,block): # loop over blocks of vectors
+    nb = min([block,ntries-i0]) # vectors in this block
+    v0 = np.exp(2j*np.pi*rand.random((nd,nb))) # random phases
+    a = block_product(m,v0) # vector number 1
+    am = v0.copy() # buffer of the previous vector
+    mus[:,0] += nb # mu0
+    mus[:,1] += np.sum(np.conjugate(v0)*a,axis=1) # mu1
+    for i in range(2,2*n):
+      am *= -0.5 # minus half the previous vector
+      block_product(m,a,out=am) # add m*a
+      am *= 2. # recursion relation, am contains the new vector
+      mus[:,i] += np.sum(np.conjugate(v0)*am,axis=1) # projection
+      (am,a) = (a,am) # swap the buffers
+  return mus/ntries
+
+
+
+def generate_profiles(mus,xs,kernel="jackson"):
+  """Profiles of several sets of moments (one per row) at once,
+  returns an array with the profile of each set"""
+  mus = np.array(mus) # array with the moments
+  g = kernel_moments(np.ones(mus.shape[1]),kernel=kernel) # factors
+  xs = np.array(xs) # energies
+  ts = np.cos(np.outer(np.arange(mus.shape[1]),np.arccos(xs))) # T_n(x)
+  g[1:] *= 2. # factor of the higher terms
+  ys = (mus*g).dot(ts) # sum the contributions
+  return ys/np.sqrt(1.-xs*xs)/np.pi
+
+
+
+def spectral_bounds(m_in,nsteps=40,margin=0.1):
+  """Estimate the lower and upper bounds of the spectrum with a few
+  Lanczos steps. The extreme Ritz values are enlarged by their
+  residuals and by a safety margin, relative to the width"""
+  from scipy.linalg import eigh_tridiagonal
+  m = csr_matrix(m_in) # sparse matrix
+  nd = m.shape[0] # length of the matrix
+  if nd<=nsteps: # small matrix, diagonalize it
+    es = np.linalg.eigvalsh(m.todense()) # eigenvalues
+    (emin,emax) = (es[0],es[-1]) # exact bounds
+  else: # Lanczos algorithm
+    v = rand.random(nd) - 0.5 # random vector
+    v = v/np.sqrt(np.vdot(v,v).real) # normalize
+    vm = np.zeros(nd) # previous vector
+    b = 0. # previous off diagonal
+    (alphas,betas) = ([],[]) # tridiagonal matrix
+    for i in range(nsteps):
+      w = m.dot(v) - b*vm # apply the matrix
+      a = np.vdot(v,w).real # diagonal element
+      w = w - a*v # orthogonalize
+      b = np.sqrt(np.vdot(w,w).real) # off diagonal element
+      alphas.append(a) ; betas.append(b) # store
+      if b<1e-10: break # invariant subspace
+      (vm,v) = (v,w/b) # next vector
+    es,evs = eigh_tridiagonal(np.array(alphas),np.array(betas[:-1]))
+    rs = np.abs(betas[-1]*evs[-1,:]) # residuals of the Ritz values
+    (emin,emax) = (es[0]-rs[0],es[-1]+rs[-1]) # bounds
+  dw = max([emax-emin,1e-6])*margin # safety margin
+  return (emin-dw,emax+dw)
+
+
+
+def get_scale(m_in,scale="auto",shift=0.,margin=0.1):
+  """Return the scale and shift that bring the spectrum of a matrix
+  inside (-1,1), estimating the bounds if scale is "auto". The matrix
+  can also be a list or a generator of matrices, bounding all of them
+  while keeping only the running minimum and maximum"""
+  if scale!="auto": return (float(scale),shift) # given on input
+  if hasattr(m_in,"shape"): (emin,emax) = spectral_bounds(m_in) # bounds
+  else: # several matrices
+    (emin,emax) = (np.inf,-np.inf) # initialize
+    for m in m_in: # loop over matrices
+      (e0,e1) = spectral_bounds(m,margin=0.) # bounds of this one
+      (emin,emax) = (min([emin,e0]),max([emax,e1])) # bounds of all
+    dw = max([emax-emin,1e-6])*margin # safety margin
+    (emin,emax) = (emin-dw,emax+dw) # enlarge
+  return ((emax-emin)/2.,(emax+emin)/2.) # scale and shift
+
+
+
+def get_scale_kpoints(hkgen,ks,dim,scale="auto",shift=0.,nsample=10,
+                        margin=0.25):
+  """Return the scale and shift for the Bloch Hamiltonians of a list
+  of kpoints, estimated from the high symmetry points and a few of the
+  kpoints. The margin is larger than for a single matrix, since the
+  band extrema may lie in between the sampled kpoints"""
+  if scale!="auto": return (float(scale),shift) # given on input
+  ks = list(ks) # kpoints
+  kb = [ks[i] for i in np.linspace(0,len(ks)-1,min([nsample,len(ks)]),
+                                      dtype=int)] # a few of them
+  import itertools
+  for k in itertools.product([0.,.5],repeat=dim): # high symmetry points
+    kb.append(np.array(list(k)+[0. for i in range(3-dim)]))
+  return get_scale((hkgen(k) for k in kb),scale=scale,
+                      margin=margin) # one at a time
+
+
+
+def rescale(m_in,scale="auto",shift=0.):
+  """Rescale a matrix as (m - shift)/scale, estimating the bounds if
+  scale is "auto". Returns the rescaled matrix, the scale and the shift"""
+  (scale,shift) = get_scale(m_in,scale=scale,shift=shift) # bounds
+  m = csr_matrix(m_in) # sparse matrix
+  if shift!=0.: m = m - shift*identity(m.shape[0],format="csr") # shift
+  return (m/scale,scale,shift)
+
+
+
+def energy_window(ne,scale,shift=0.,ewindow=None):
+  """Rescaled energies in (-1,1), only those inside (-ewindow,ewindow)
+  if ewindow is provided"""
+  if ewindow is None: (x0,x1) = (-1.,1.) # whole spectrum
+  else: # restrict to the window
+    x0 = max([-1.,(-abs(ewindow)-shift)/scale])
+    x1 = min([1.,(abs(ewindow)-shift)/scale])
+  return np.linspace(x0,x1,ne,endpoint=True)*0.99 # energies
+
+
+
+def ldos0d(m_in,i=0,scale="auto",npol=None,ne=500,kernel="jackson",
+              shift=0.):
   """Return two arrays with energies and local DOS"""
   if npol is None: npol = ne
-  mus = local_dos(m_in/scale,i=i,n=npol) # get coefficients
-  xs = np.linspace(-1.0,1.0,ne,endpoint=True)*0.99 # energies
+  (m,scale,shift) = rescale(m_in,scale=scale,shift=shift) # rescale
+  mus = local_dos(m,i=i,n=npol) # get coefficients
+  xs = energy_window(ne,scale,shift) # energies
   ys = generate_profile(mus,xs,kernel=kernel)
-  return (scale*xs,ys/scale)
+  return (scale*xs+shift,ys/scale)
 
 
 
@@ -214,23 +422,137 @@ ldos = ldos0d
 
 
 
-def tdos(m_in,scale=10.,npol=None,ne=500,kernel="jackson",
-              ntries=20,ewindow=None,frand=None):
+def tdos(m_in,scale="auto",npol=None,ne=500,kernel="jackson",
+              ntries=20,ewindow=None,frand=None,shift=0.):
   """Return two arrays with energies and local DOS"""
   if npol is None: npol = ne
-  mus = random_trace(m_in/scale,ntries=ntries,n=npol,fun=frand) 
-  if ewindow is None or abs(ewindow)>scale: # no window provided
-    xs = np.linspace(-1.0,1.0,ne,endpoint=True)*0.99 # energies
-  else:
-    xx = abs(ewindow/scale) # scale
-    xs = np.linspace(-xx,xx,ne,endpoint=True)*0.99 # energies
-  ys = generate_profile(mus,xs,kernel=kernel).real
-  return (scale*xs,ys/scale)
+  mo = tdos_moments(m_in,scale=scale,npol=npol,ntries=ntries,frand=frand,
+                      shift=shift) # compute the moments
+  return mo.dos(ne=ne,kernel=kernel,ewindow=ewindow)
 
 
 tdos0d = tdos # redefine
 
 
+
+class kpm_moments():
+  """Chebyshev moments of a KPM calculation, together with the scale
+  and shift of the Hamiltonian, the number of random vectors and the
+  fingerprint of the Hamiltonian, so that the profiles can be rendered
+  again with any kernel, grid or number of moments"""
+  def __init__(self,mus=np.zeros(0),scale=1.,shift=0.,ntries=1,
+                 fingerprint="",kind="dos"):
+    self.mus = np.array(mus,dtype=np.complex128) # moments
+    self.scale = scale # scale of the Hamiltonian
+    self.shift = shift # shift of the Hamiltonian
+    self.ntries = ntries # number of random vectors
+    self.fingerprint = fingerprint # hash of the Hamiltonian
+    self.kind = kind # type of moments
+  def get_moments(self,npol=None):
+    """Return the first 2*npol moments, as npol is used in the rest 
+    of the KPM functions"""
+    if npol is None: return self.mus # all of them
+    if 2*npol>self.mus.shape[-1]: # not enough moments
+      raise ValueError("Only "+str(self.mus.shape[-1]//2)+" polynomials")
+    return self.mus[...,0:2*npol]
+  def dos(self,x=None,ne=500,kernel="jackson",npol=None,ewindow=None):
+    """Return the energies and the DOS, in the energies x or in ne
+    energies inside the window"""
+    mus = self.get_moments(npol) # moments
+    if x is None: xs = energy_window(ne,self.scale,self.shift,ewindow)
+    else: xs = (np.array(x)-self.shift)/self.scale # rescaled energies
+    if len(mus.shape)==2: ys = generate_profiles(mus,xs,kernel=kernel)
+    else: ys = generate_profile(mus,xs,kernel=kernel)
+    return (self.scale*xs+self.shift,ys.real/self.scale)
+  def green(self,x=None,ne=500,kernel="jackson",npol=None,ewindow=None):
+    """Return the energies and the Green function"""
+    mus = self.get_moments(npol) # moments
+    if x is None: xs = energy_window(ne,self.scale,self.shift,ewindow)
+    else: xs = (np.array(x)-self.shift)/self.scale # rescaled energies
+    if len(mus.shape)==2: # one row per site
+      ys = np.array([generate_green_profile(m,xs,kernel=kernel) for m in mus])
+    else: ys = generate_green_profile(mus,xs,kernel=kernel)
+    ys = ys/self.scale*np.pi # Green function
+    return (self.scale*xs+self.shift,ys)
+  def merge(self,other):
+    """Merge with the moments of another run of the same Hamiltonian,
+    weighted with their number of random vectors"""
+    if self.fingerprint!=other.fingerprint: # different Hamiltonian
+      raise ValueError("Moments of different Hamiltonians")
+    if self.kind!=other.kind: # different type
+      raise ValueError("Moments of different kind")
+    if abs(self.scale-other.scale)>1e-10: # different scale
+      raise ValueError("Moments with different scale")
+    if abs(self.shift-other.shift)>1e-10: # different shift
+      raise ValueError("Moments with different shift")
+    if self.mus.shape[0:-1]!=other.mus.shape[0:-1]: # different sites
+      raise ValueError("Moments with different shape")
+    n = min([self.mus.shape[-1],other.mus.shape[-1]]) # common moments
+    nt = self.ntries + other.ntries # total number of vectors
+    mus = (self.ntries*self.mus[...,0:n] + other.ntries*other.mus[...,0:n])
+    return kpm_moments(mus=mus/nt,scale=self.scale,shift=self.shift,
+                ntries=nt,fingerprint=self.fingerprint,kind=self.kind)
+  def add_vectors(self,m_in,ntries=20,frand=None):
+    """Add more random vectors to moments of the total DOS, with the
+    same scale and shift, returns the merged moments"""
+    if self.kind!="dos": # only for the total DOS
+      raise ValueError("Random vectors only for moments of the total DOS")
+    if fingerprint(m_in)!=self.fingerprint: # different Hamiltonian
+      raise ValueError("Matrix differs from the one of the moments")
+    mo = tdos_moments(m_in,scale=self.scale,shift=self.shift,
+             npol=self.mus.shape[-1]//2,ntries=ntries,frand=frand) 
+    return self.merge(mo)
+  def save(self,output_file="KPM_MOMENTS.npz"):
+    """Save the moments in a binary file"""
+    np.savez(output_file,mus=self.mus,scale=self.scale,shift=self.shift,
+               ntries=self.ntries,fingerprint=self.fingerprint,
+               kind=self.kind)
+
+
+
+def load_moments(input_file="KPM_MOMENTS.npz"):
+  """Load moments from a binary file"""
+  d = np.load(input_file) # read all the arrays
+  return kpm_moments(mus=d["mus"],scale=float(d["scale"]),
+              shift=float(d["shift"]),ntries=int(d["ntries"]),
+              fingerprint=str(d["fingerprint"]),kind=str(d["kind"]))
+
+
+
+def merge_moments(ms):
+  """Merge a list of moments"""
+  out = ms[0] # first one
+  for m in ms[1:]: out = out.merge(m) # merge the rest
+  return out
+
+
+
+def fingerprint(m_in):
+  """Hash of a Hamiltonian"""
+  from green import matrix_hash
+  return matrix_hash(csc_matrix(m_in))
+
+
+
+def tdos_moments(m_in,scale="auto",npol=500,ntries=20,frand=None,shift=0.):
+  """Return the moments of the total DOS"""
+  (m,scale,shift) = rescale(m_in,scale=scale,shift=shift) # rescale
+  mus = random_trace(m,ntries=ntries,n=npol,
+                        fun=frand) 
+  return kpm_moments(mus=mus,scale=scale,shift=shift,ntries=ntries,
+                       fingerprint=fingerprint(m_in),kind="dos")
+
+
+
+def ldos_moments(m_in,sites=None,scale="auto",npol=500,shift=0.):
+  """Return the moments of the local DOS of several sites, or of all 
+  of them if sites is None"""
+  (m,scale,shift) = rescale(m_in,scale=scale,shift=shift) # rescale
+  mus = local_dos_sites(m,sites=sites,n=npol) 
+  return kpm_moments(mus=mus,scale=scale,shift=shift,ntries=1,
+                       fingerprint=fingerprint(m_in),kind="ldos")
+
+
 def total_energy(m_in,scale=10.,npol=None,ne=500,ntries=20):
    x,y = tdos0d(m_in,scale=scale,npol=npol,ne=ne,ntries=ntries)
    z = .5*(np.sign(x)+1.)*x*y # function to integrate
@@ -238,22 +560,22 @@ def total_energy(m_in,scale=10.,npol=None,ne=500,ntries=20):
 
 
 
-def random_trace(m_in,ntries=20,n=200,fun=None):
-  """ Calculates local DOS using the KPM"""
+def random_trace(m_in,ntries=20,n=200,fun=None,block=32):
+  """ Calculates local DOS using the KPM, with all the random vectors
+  propagated together in blocks"""
   if fun is not None: # check that dimensions are fine
     v0 = fun()
     if len(v0) != m_in.shape[0]: raise
   if fun is None:
 #    def fun(): return rand.random(nd) -.5 + 1j*rand.random(nd) -.5j
     def fun(): return rand.random(nd) - 0.5
-  m = csc(m_in) # saprse matrix
+  m = csr_matrix(m_in) # saprse matrix
   nd = m.shape[0] # length of the matrix
-  mus = np.array([0.0j for j in range(2*n)])
-  for i in range(ntries): # loop over tries
-    v = fun()
-    v = v/np.sqrt(v.dot(np.conjugate(v))) # normalize the vector
-    v = csc(v).transpose()
-    mus += get_moments(v,m,n=n) # get the chebychev moments
+  mus = np.zeros(2*n,dtype=np.complex128) # moments
+  for i in range(0,ntries,block): # loop over blocks of tries
+    vs = np.array([fun() for j in range(min([block,ntries-i]))]).T # vectors
+    vs = vs/np.sqrt(np.sum(np.abs(vs)**2,axis=0)) # normalize the vectors
+    mus += block_moments(m,vs,n=n,block=block)*vs.shape[1] # add moments
   return mus/ntries
 
 
@@ -342,51 +664,96 @@ def dm_vivj_energy(m_in,vi,vj,scale=10.,npol=None,ne=500,x=None):
 
 
 
-def generate_profile(mus,xs,kernel="jackson",use_fortran=use_fortran):
-  """ Uses the Chebychev expansion to create a certain profile"""
-  # initialize polynomials
-#  xs = np.array([0.])
-  tm = np.zeros(xs.shape) +1.
-  t = xs.copy()
-  if kernel=="jackson": mus = jackson_kernel(mus)
-  elif kernel=="lorentz": mus = lorentz_kernel(mus)
+def kernel_moments(mus,kernel="jackson"):
+  """Apply a kernel to the moments"""
+  if kernel=="jackson": return jackson_kernel(mus)
+  elif kernel=="lorentz": return lorentz_kernel(mus)
+  elif kernel=="fejer": return fejer_kernel(mus)
   else: raise
+
+
+
+def generate_profile(mus,xs,kernel="jackson",use_fortran=use_fortran,
+                        nodes=None):
+  """ Uses the Chebychev expansion to create a certain profile"""
   if use_fortran: # call the fortran routine
+    mus = kernel_moments(mus,kernel=kernel) # apply the kernel
     ys = kpmf90.generate_profile(mus,xs) 
-  else: # do a python loop
-    ys = np.zeros(xs.shape,dtype=np.complex) + mus[0] # first term
-    # loop over all contributions
-    for i in range(1,len(mus)):
-      mu = mus[i]
-      ys += 2.*mu*t # add contribution
-      tp = 2.*xs*t - tm # chebychev recursion relation
-      tm = t + 0.
-      t = 0. + tp # next iteration
-    ys = ys/np.sqrt(1.-xs*xs) # prefactor
-  ys = ys/np.pi
-  return ys
+    return ys/np.pi
+  else: # use the discrete cosine transform
+    return dct_profile(mus,xs,kernel=kernel,nodes=nodes)[1]
 
 
 
+def chebyshev_nodes(mus,xs=None,nodes=None):
+  """Number of Chebyshev nodes for a reconstruction, a few times the
+  number of moments and of points"""
+  if nodes is not None: # given on input
+    if nodes<len(mus): 
+      raise ValueError("Fewer Chebyshev nodes than moments")
+    return nodes
+  nodes = 16*len(mus) # several nodes per moment
+  if xs is not None: nodes = max([nodes,2*len(xs)]) # and per point
+  return nodes
 
-def generate_green_profile(mus,xs,kernel="jackson",use_fortran=use_fortran):
-  """ Uses the Chebychev expansion to create a certain profile"""
-  # initialize polynomials
-#  xs = np.array([0.])
-  tm = np.zeros(xs.shape) +1.
-  t = xs.copy()
-  ys = np.zeros(xs.shape,dtype=np.complex) + mus[0]/2 # first term
-  if kernel=="jackson": mus = jackson_kernel(mus)
-  elif kernel=="lorentz": mus = lorentz_kernel(mus)
-  else: raise
-  if True:
-    for i in range(1,len(mus)): # loop over mus
-      ys += np.exp(1j*i*np.arccos(xs))*mus[i] # add contribution
-    ys = ys/np.sqrt(1.-xs*xs)
-    return 1j*2*ys/np.pi
-#    if use_fortran: # call the fortran routine
-#      ys = kpmf90.generate_profile(mus,xs) 
-#    return ys
+
+
+def dct_profile(mus,xs=None,kernel="jackson",nodes=None):
+  """Reconstruct the profile of the Chebyshev expansion on the Chebyshev
+  nodes with a discrete cosine transform. If xs is None, returns the
+  nodes and the profile on them, otherwise the profile is interpolated
+  to xs"""
+  mus = kernel_moments(np.array(mus),kernel=kernel) # apply the kernel
+  nodes = chebyshev_nodes(mus,xs=xs,nodes=nodes) # number of nodes
+  cs = np.zeros(nodes,dtype=mus.dtype) # coefficients
+  cs[0:len(mus)] = mus # store the moments
+  ts = np.pi*(np.arange(nodes)+0.5)/nodes # angles of the nodes
+  ys = dct(cs,type=3) # c0 + 2 sum_n c_n cos(n theta)
+  if xs is None: # return the profile on the nodes
+    xs = np.cos(ts)[::-1] # increasing energies
+    ys = ys[::-1]/np.sqrt(1.-xs*xs) # prefactor
+    return (xs,ys/np.pi)
+  # extend using that the function is even in theta and 2pi-theta
+  tse = np.concatenate([-ts[1::-1],ts,2*np.pi-ts[:-3:-1]]) 
+  yse = np.concatenate([ys[1::-1],ys,ys[:-3:-1]]) 
+  xs = np.array(xs) # energies
+  ys = interpolate_angle(tse,yse,np.arccos(xs))/np.sqrt(1.-xs*xs) 
+  return (xs,ys/np.pi)
+
+
+
+def interpolate_angle(ts,ys,t):
+  """Cubic interpolation of a function of the angle"""
+  from scipy.interpolate import CubicSpline
+  if np.iscomplexobj(ys): # real and imaginary parts
+    return CubicSpline(ts,ys.real)(t) + 1j*CubicSpline(ts,ys.imag)(t)
+  else: return CubicSpline(ts,ys)(t)
+
+
+
+
+def generate_green_profile(mus,xs,kernel="jackson",use_fortran=use_fortran,
+                              nodes=None):
+  """ Uses the Chebychev expansion to create a certain profile. The
+  sum of mu_n exp(i n theta) is performed on equispaced angles with a
+  fast Fourier transform, and interpolated to xs"""
+  mus = np.array(mus) # moments
+  mu0 = mus[0] # first moment
+  mus = kernel_moments(mus,kernel=kernel) # apply the kernel
+  mus[0] = mu0/2 # first term
+  nodes = chebyshev_nodes(mus,xs=xs,nodes=nodes) # number of nodes
+  nt = 2*nodes # angles in the whole circle
+  cs = np.zeros(nt,dtype=np.complex128) # coefficients
+  ns = np.arange(min([nt,len(mus)])) # indexes of the moments
+  cs[ns] = mus[ns]*np.exp(1j*np.pi*ns/nt) # shift to the nodes
+  ts = np.pi*(np.arange(nt)+0.5)/nodes # angles of the nodes
+  ys = np.fft.ifft(cs)*nt # sum_n c_n exp(i n theta)
+  # extend using that the function is periodic
+  tse = np.concatenate([ts[-2:]-2*np.pi,ts[0:nodes+2]])
+  yse = np.concatenate([ys[-2:],ys[0:nodes+2]]) 
+  xs = np.array(xs) # energies
+  ys = interpolate_angle(tse,yse,np.arccos(xs))/np.sqrt(1.-xs*xs)
+  return 1j*2*ys/np.pi
 
 
 
@@ -452,22 +819,13 @@ def edge_dos(intra0,inter0,scale=4.,w=20,npol=300,ne=500,bulk=False,
     h[i+1][i] = inter.H
     h[i][i+1] = inter
   h = bmat(h) # sparse hamiltonian
-  ds = np.zeros(ne)
-  dsb = np.zeros(ne)
   norb = intra0.shape[0] # orbitals ina cell
-  for i in range(norb):
-    (xs,ys) = ldos0d(h,i=i,scale=scale,npol=npol,ne=ne) 
-    ds += ys # store
-    if bulk:
-      (xs,zs) = ldos0d(h,i=w*norb//2 + i,scale=scale,npol=npol,ne=ne) 
-      dsb += zs # store
-  if not bulk: return (xs,ds/w)
-  else: return (xs,ds/w,dsb/w)
-
-
-
-
-
-
-
-
+  xs = np.linspace(-1.0,1.0,ne,endpoint=True)*0.99 # energies
+  sites = range(norb) # orbitals of the edge
+  mus = np.sum(local_dos_sites(h/scale,sites=sites,n=npol),axis=0)
+  ds = generate_profile(mus,xs).real/scale # edge DOS
+  if not bulk: return (scale*xs,ds/w)
+  sites = [w*norb//2 + i for i in range(norb)] # orbitals in the middle
+  mus = np.sum(local_dos_sites(h/scale,sites=sites,n=npol),axis=0)
+  dsb = generate_profile(mus,xs).real/scale # bulk DOS
+  return (scale*xs,ds/w,dsb/w)
@@ -25,6 +25,26 @@ def ldos0d(h,e=0.0,delta=0.01):
 
 
 
+def ldos0d_kpm(h,e=0.0,delta=0.01,scale="auto",npol=None,ntries=None):
+  """Calculates the local density of states of all the sites with the
+     KPM in a single run, and writes it in file. If ntries is given,
+     random phase vectors are used instead of one vector per site"""
+  import kpm
+  if h.dimensionality!=0: raise # only for 0d
+  (m,scale,shift) = kpm.rescale(h.intra,scale=scale) # spectral bounds
+  if npol is None: npol = int(scale/delta) # number of polynomials
+  if ntries is None: mus = kpm.local_dos_sites(m,n=npol) # exact
+  else: mus = kpm.stochastic_local_dos(m,n=npol,ntries=ntries)
+  d = kpm.generate_profiles(mus,[(e-shift)/scale])[:,0].real/scale # LDOS
+  d = spatial_dos(h,d) # convert to spatial resolved DOS
+  g = h.geometry  # store geometry
+  write_ldos(g.x,g.y,d,z=g.z) # write in file
+  return d
+
+
+
+
+
 def ldos0d_wf(h,e=0.0,delta=0.01,num_wf = 10,robust=False,tol=0):
   """Calculates the local density of states of a hamiltonian and
      writes it in file, using arpack"""
@@ -2,57 +2,111 @@
 
 import numpy as np
 import neighbor
+from scipy.sparse import csc_matrix,identity,diags
 
 class Device():
   """ Device with leads and scattering part"""
   def __init__(self):
     self.leads = [] # empty list of leads
   def biterminal(self,right_g=None,left_g=None,central_g=None,fun=None,
-                    disorder=0.0):
-    """Create the matrices for a biterminal device, based on geometries"""
-    if fun is None: # no function provided
-      def fun(r1,r2):
-        dr = r1-r2
-        if .7<dr.dot(dr)<1.3: return True
-        else: return False
+                    disorder=0.0,cutoff=None):
+    """Create the matrices for a biterminal device, based on geometries.
+    If cutoff is given, the function fun is only evaluated for distances
+    below it, otherwise for all the pairs"""
+    if fun is None: fun = first_neighbor_hopping # default
+    hop = lambda r1,r2: np.matrix(neighbor.neighbor_hopping(r1,r2,fun,
+                                    cutoff=cutoff).todense()) # hopping
     leadr = Lead() # right lead
     leadl = Lead() # left lead
     Rr = right_g.r # positions
     Lr = left_g.r # positions
     Cr = central_g.r # positions
-    leadr.intra = neighbor.parametric_hopping(Rr,Rr,fun) # intra term
-    leadl.intra = neighbor.parametric_hopping(Lr,Lr,fun) # intra term
-    intra = neighbor.parametric_hopping(Cr,Cr,fun) # intra term
+    leadr.intra = hop(Rr,Rr) # intra term
+    leadl.intra = hop(Lr,Lr) # intra term
+    intra = hop(Cr,Cr) # intra term
     for i in range(intra.shape[0]): # add disorder
       intra[i,i] += disorder*(np.random.random()-.5)
     self.intra = intra # store
-    leadr.coupling = neighbor.parametric_hopping(Rr,Cr,fun) # coupling
-    leadl.coupling = neighbor.parametric_hopping(Lr,Cr,fun) # coupling
+    leadr.coupling = hop(Rr,Cr) # coupling
+    leadl.coupling = hop(Lr,Cr) # coupling
     # now coupling within the lead
     Rr_dis = [r-right_g.a1 for r in Rr] # displace
     Lr_dis = [r-left_g.a1 for r in Lr] # displace
-    leadr.inter = neighbor.parametric_hopping(Rr,Rr_dis,fun) # intra term
-    leadl.inter = neighbor.parametric_hopping(Lr,Lr_dis,fun) # intra term
+    leadr.inter = hop(Rr,Rr_dis) # intra term
+    leadl.inter = hop(Lr,Lr_dis) # intra term
     # store positions
     leadr.r = Rr
     leadl.r = Lr
     self.r = Cr
     # store leads
     self.leads = [leadr,leadl] # store the leads
+  def multiterminal(self,central_g,leads_g,fun=None,disorder=0.0,
+                      cutoff=1.5):
+    """Create a device with an arbitrary number of leads, storing all the
+    matrices in sparse form. central_g is the geometry of the scattering
+    region and leads_g a list with the geometries of the first cell of
+    each lead, whose vector a1 points away from the scattering region.
+    The function fun is only evaluated for distances below cutoff"""
+    if fun is None: fun = first_neighbor_hopping # default
+    hop = lambda r1,r2: neighbor.neighbor_hopping(r1,r2,fun,cutoff=cutoff)
+    Cr = np.array(central_g.r) # positions
+    intra = hop(Cr,Cr) # intra term
+    dis = disorder*(np.random.random(len(Cr))-.5) # onsite disorder
+    self.intra = (intra + diags(dis,format="csc")).tocsc() # store
+    self.leads = [] # empty list
+    for g in leads_g: # loop over leads
+      lead = Lead() # create lead
+      lead.r = np.array(g.r) # positions of the first cell
+      lead.intra = hop(lead.r,lead.r) # intra term
+      lead.inter = hop(lead.r,lead.r+np.array(g.a1)) # to the next cell
+      lead.coupling = hop(lead.r,Cr) # coupling to the center
+      self.leads.append(lead) # store
+    self.r = Cr # store positions
+  def transmission_matrix(self,energy=0.0,delta=0.00001):
+    """Return the transmission matrix between all the leads"""
+    return transmission_matrix(self,energy=energy,delta=delta)
   def write(self):
     """Write positions of the atoms"""
     np.savetxt("CENTRAL.XYZ",self.r) # write central
     for i in range(len(self.leads)): 
       np.savetxt("LEAD_"+str(i)+".XYZ",self.leads[i].r) # write lead
     
+  def get_heterostructure(self,block_diagonal=True):
+    """Return a heterostructure for a biterminal device, by default
+    partitioned in block tridiagonal form"""
+    import heterostructures
+    (leadr,leadl) = self.leads # right and left leads
+    ht = heterostructures.heterostructure() # empty heterostructure
+    ht.has_spin = False
+    ht.has_eh = False
+    dense = lambda m: np.matrix(heterostructures.dense_block(m)) # dense
+    ht.right_intra = dense(leadr.intra)
+    ht.right_inter = dense(leadr.inter)
+    ht.left_intra = dense(leadl.intra)
+    ht.left_inter = dense(leadl.inter)
+    ht.central_intra = self.intra
+    # couplings from the center to the leads
+    ht.right_coupling = dense(leadr.coupling[0:len(leadr.r),:]).H
+    ht.left_coupling = dense(leadl.coupling[0:len(leadl.r),:]).H
+    if block_diagonal: ht = heterostructures.partition(ht)
+    return ht
   def transmission(self,energy=0.0):
     """Calculate the transmission"""
     return landauer(self,energy)
+  def local_transport(self,energy=0.0,delta=0.00001):
+    """Bond currents and injected density of states of a biterminal
+    device, as a transport_map object"""
+    import heterostructures
+    ht = self.get_heterostructure() # get the heterostructure
+    return heterostructures.local_transport(ht,energy=energy,delta=delta)
   def write_current(self,energy=0.0):
-    """Calculate the transmission"""
-    den = central_density(self,energy=energy)
-    from ldos import write_ldos
-    write_ldos(self.r[:,0],self.r[:,1],den,output_file="CURRENT.OUT")
+    """Write the bond currents injected from the left lead, as
+    x_i, y_i, x_j, y_j, J_ij"""
+    tm = self.local_transport(energy=energy) # local transport
+    (i,j) = tm.bonds[:,0],tm.bonds[:,1] # sites of each bond
+    m = np.array([self.r[i,0],self.r[i,1],self.r[j,0],self.r[j,1],
+                    tm.current[0]]).T # bond positions and currents
+    np.savetxt("CURRENT.OUT",m)
 
 
 
@@ -63,10 +117,11 @@ class Lead():
   coupling = None  # coupling to the center
   def get_green(self,energy,error=0.00001,delta=0.00001):
     """ Get surface green function"""
-    import green 
-    grb,gr = green.green_renormalization(self.intra,self.inter,error=error,
-                                          energy=energy,delta=delta)
-    return gr
+    from green import lead_cache
+    from heterostructures import dense_block
+    intra = np.matrix(dense_block(self.intra)) # dense intra term
+    inter = np.matrix(dense_block(self.inter)) # dense inter term
+    return lead_cache.surface_green(intra,inter,energy=energy,delta=delta)
   def get_selfenergy(self,energy,error=0.0001,delta=0.0001):
     """ Get selfenergy"""
     gr = self.get_green(energy,error=error,delta=delta) # get greenfunction
@@ -75,11 +130,52 @@ class Lead():
     return selfenergy
 
 
+def first_neighbor_hopping(r1,r2):
+  """Unit hopping between sites at unit distance"""
+  dr = r1-r2
+  if .7<dr.dot(dr)<1.3: return 1.0
+  else: return 0.0
+
+
+
 def landauer(d,energy,ij=[(0,1)],error=0.000001,delta=0.00001):
   """ Calculate landauer tranmission between leads i,j """
-  Ms = landauer_matrix(d,energy,ij=ij,error=error,delta=delta) # matrix
-  Ts = [m.trace()[0,0] for m in Ms]
-  return Ts
+  T = transmission_matrix(d,energy=energy,delta=delta) # all the leads
+  return [T[i,j] for (i,j) in ij]
+
+
+
+def transmission_matrix(d,energy=0.0,delta=0.00001):
+  """Return the matrix T[i,j] with the transmission from lead j to lead i.
+  Only the blocks of the Green function between the sites coupled to the
+  leads are computed, with a single sparse factorization"""
+  from heterostructures import interface_indexes,embed_block
+  from heterostructures import sparse_green_columns
+  n = d.intra.shape[0] # dimension of the scattering region
+  m = (energy+1j*delta)*identity(n,format="csc",dtype=np.complex128)
+  m = m - csc_matrix(d.intra) # E - H
+  iis = [] # sites coupled to each lead
+  gammas = [] # gammas of each lead in those sites
+  for lead in d.leads: # loop over leads
+    t = csc_matrix(lead.coupling) # coupling from lead to center
+    ii = interface_indexes(t.T) # central sites coupled to the lead
+    ti = np.matrix(t[:,ii].todense()) # coupling to those sites
+    s = ti.H*lead.get_green(energy,delta=delta)*ti # selfenergy
+    m = m - embed_block(s,ii,n) # add the selfenergy
+    iis.append(ii) # store
+    gammas.append(np.asarray(1j*(s-s.H))) # store
+  cols = np.concatenate(iis) # all the interface sites
+  g = sparse_green_columns(m,cols)[cols,:] # interface block of G
+  bounds = np.cumsum([0]+[len(ii) for ii in iis]) # limits of each lead
+  nl = len(d.leads) # number of leads
+  T = np.zeros((nl,nl)) # transmission matrix
+  for i in range(nl):
+    for j in range(nl):
+      if i==j: continue # only between different leads
+      gij = g[bounds[i]:bounds[i+1],bounds[j]:bounds[j+1]] # block G_ij
+      T[i,j] = np.trace(gammas[i].dot(gij).dot(gammas[j]).dot(
+                          gij.conj().T)).real # Landauer formula
+  return T
 
 
 def landauer_matrix(d,energy,ij=[(0,1)],error=0.000001,delta=0.00001):
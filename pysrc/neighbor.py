@@ -82,6 +82,34 @@ def parametric_hopping(r1,r2,fc,is_sparse=False):
 
 
 
+def neighbor_hopping(r1,r2,fc,cutoff=1.5):
+  """ Generates a sparse parametric hopping based on a function, that
+  is only evaluated for the pairs closer than cutoff, found with
+  a KD-tree. If cutoff is None all the pairs are evaluated"""
+  from scipy.spatial import cKDTree
+  r1 = np.array(r1) # positions
+  r2 = np.array(r2) # positions
+  if cutoff is None: # all the pairs
+    pairs = [range(len(r2)) for i in range(len(r1))]
+  else: # pairs closer than the cutoff
+    t1 = cKDTree(r1) # tree with the first positions
+    t2 = cKDTree(r2) # tree with the second positions
+    pairs = t1.query_ball_tree(t2,cutoff) # close pairs
+  rows,cols,data = [],[],[]
+  for (i,js) in enumerate(pairs): # loop over pairs
+    for j in js:
+      val = fc(r1[i],r2[j]) # add hopping based on function
+      if abs(val)>0.: # retain this hopping
+        data.append(val)
+        rows.append(i)
+        cols.append(j)
+  return csc_matrix((data,(rows,cols)),shape=(len(r1),len(r2)),
+                      dtype=np.complex128)
+
+
+
+
+
 def parametric_hopping_spinful(r1,r2,fc,is_sparse=False):
   """ Generates a parametric hopping based on a function, that returns
   a 2x2 matrix"""
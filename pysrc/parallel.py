@@ -51,3 +51,96 @@ def pcall(fun,args): # define the function
   if cores==1: return pcall_serial(fun,args) # one core, simply iterate
   else: return pcall_mp(fun,args) # call in parallel
 
+
+
+
+
+sweep_data = None # function and object shared with the workers of a sweep
+
+def sweep_initializer(fun,obj):
+  """Store the function and the object in each worker, only once"""
+  global sweep_data
+  sweep_data = (fun,obj)
+
+
+def sweep_call(arg):
+  """Call the stored function for a certain argument"""
+  (fun,obj) = sweep_data
+  return fun(obj,arg)
+
+
+
+class sweeper():
+  """Workers sharing a function and an object, which reach each worker
+  only once when the pool is forked. The pool is reused for several
+  sweeps until close is called. Runs in serial with a single core, or
+  inside a worker of another pool (which can not have children)"""
+  def __init__(self,fun,obj,cores=None):
+    import multiprocessing
+    if cores is None: cores = globals()["cores"] # use the global value
+    if multiprocessing.current_process().daemon: cores = 1 # in a worker
+    self.fun = fun # function
+    self.obj = obj # object
+    self.cores = cores # number of cores
+    self.pool = None # pool of workers, created when needed
+  def iter(self,args,chunksize=1):
+    """Generator that evaluates fun(obj,a) for every a in args, yielding
+    the results in order as soon as they are available"""
+    if self.cores==1: # one core, simply iterate
+      for a in args: yield self.fun(self.obj,a)
+      return
+    if self.pool is None: # fork the workers
+      from multiprocessing import Pool
+      self.pool = Pool(self.cores,initializer=sweep_initializer,
+                         initargs=(self.fun,self.obj))
+    for r in self.pool.imap(sweep_call,args,chunksize=chunksize): yield r
+  def map(self,args,chunksize=1):
+    """Evaluate fun(obj,a) for every a in args, returns a list"""
+    return list(self.iter(args,chunksize=chunksize))
+  def chunks(self,args,nchunks=None):
+    """Evaluate fun(obj,chunk) for contiguous chunks of args, where fun
+    returns a list with one result per element of the chunk (e.g. a list
+    of energies). Returns the concatenated results in the original order"""
+    args = list(args) # all the arguments
+    if nchunks is None: nchunks = 4*self.cores # a few chunks per core
+    nchunks = max([1,min([nchunks,len(args)])]) # at most one per argument
+    bounds = [len(args)*i//nchunks for i in range(nchunks+1)] # limits
+    chunks = [args[bounds[i]:bounds[i+1]] for i in range(nchunks)]
+    out = [] # output list
+    for r in self.iter(chunks): out += list(r)
+    return out
+  def close(self):
+    """Kill the workers"""
+    if self.pool is not None:
+      self.pool.terminate() 
+      self.pool.join()
+      self.pool = None
+  def __del__(self): self.close()
+
+
+
+def sweep_iter(fun,obj,args,cores=None,chunksize=1):
+  """Generator that evaluates fun(obj,a) for every a in args, yielding
+  the results in order as soon as they are available. The object
+  (e.g. a heterostructure) reaches each worker only once, inherited
+  when the pool is forked, and only the arguments travel with each task"""
+  sw = sweeper(fun,obj,cores=cores) # workers for this sweep
+  try:
+    for r in sw.iter(args,chunksize=chunksize): yield r
+  finally: sw.close() # kill the workers
+
+
+
+def sweep(fun,obj,args,cores=None,chunksize=1):
+  """Evaluate fun(obj,a) for every a in args in parallel, returns a list"""
+  return list(sweep_iter(fun,obj,args,cores=cores,chunksize=chunksize))
+
+
+
+def sweep_chunks(fun,obj,args,cores=None,nchunks=None):
+  """Evaluate fun(obj,chunk) for contiguous chunks of args, where fun
+  returns a list with one result per element of the chunk (e.g. a list
+  of energies). Returns the concatenated results in the original order"""
+  sw = sweeper(fun,obj,cores=cores) # workers for this sweep
+  try: return sw.chunks(args,nchunks=nchunks)
+  finally: sw.close() # kill the workers
@@ -0,0 +1,226 @@
+# binary storage of heterostructures and surface Green functions
+
+from __future__ import print_function
+import numpy as np
+import os
+import json
+from scipy.sparse import issparse,csc_matrix
+
+version = 1 # version of the format
+header_name = "header.json" # name of the header in each folder
+
+
+def save_npy(filename,a):
+  """Save an array in a temporary file that then replaces the target,
+  so that arrays memory mapped from the old file remain valid"""
+  (folder,name) = os.path.split(filename)
+  tmp = os.path.join(folder,".tmp_"+name) # temporary file
+  np.save(tmp,a)
+  os.replace(tmp,filename) # the old file is removed once unmapped
+
+
+
+def save_array(path,name,m):
+  """Save a dense or sparse matrix as raw npy files in a folder,
+  returns the entry describing it in the header"""
+  if m is None: return None
+  if issparse(m): # sparse matrix, save the csc arrays
+    m = csc_matrix(m)
+    for (k,a) in [("data",m.data),("indices",m.indices),("indptr",m.indptr)]:
+      save_npy(os.path.join(path,name+"_"+k+".npy"),a)
+    return {"name":name,"type":"sparse","shape":list(m.shape)}
+  else: # dense matrix or array
+    save_npy(os.path.join(path,name+".npy"),np.asarray(m))
+    if isinstance(m,np.matrix): return {"name":name,"type":"matrix"}
+    else: return {"name":name,"type":"array"}
+
+
+
+def load_array(path,entry,mmap=True):
+  """Load a matrix described by an entry of the header. If mmap is True
+  the file is memory mapped (copy on write), so the data is only
+  read from disk when it is used"""
+  if entry is None: return None
+  mode = "c" if mmap else None # copy on write
+  name = entry["name"]
+  if entry["type"]=="sparse": # sparse matrix
+    a = [np.load(os.path.join(path,name+"_"+k+".npy"),mmap_mode=mode)
+            for k in ["data","indices","indptr"]]
+    return csc_matrix(tuple(a),shape=tuple(entry["shape"]),copy=False)
+  m = np.load(os.path.join(path,name+".npy"),mmap_mode=mode)
+  if entry["type"]=="matrix": return np.asmatrix(m) # no copy
+  return m
+
+
+
+def plain(value):
+  """Convert numpy scalars to python ones, to write them in JSON"""
+  if isinstance(value,np.generic): return value.item()
+  return value
+
+
+
+def write_header(path,header):
+  """Write the header of a folder"""
+  header["version"] = version # store the version
+  tmp = os.path.join(path,".tmp_"+header_name) # temporary file
+  f = open(tmp,"w")
+  json.dump(header,f,indent=1)
+  f.close()
+  os.replace(tmp,os.path.join(path,header_name)) # replace the old one
+
+
+
+def read_header(path,kind):
+  """Read the header of a folder, checking its kind and version"""
+  f = open(os.path.join(path,header_name))
+  header = json.load(f)
+  f.close()
+  if header.get("kind")!=kind: raise # wrong type of file
+  if header.get("version",0)>version: raise # written by a newer version
+  return header
+
+
+
+heterostructure_attributes = ["dimensionality","delta","block_diagonal",
+   "is_sparse","has_spin","has_eh","lead_solver","file_right_green",
+   "file_left_green","file_heff"] # attributes stored in the header
+lead_matrices = ["right_intra","right_inter","left_intra","left_inter",
+   "right_coupling","left_coupling"] # matrices of the leads
+
+
+def save_heterostructure(ht,path,green=True):
+  """Save a heterostructure in a folder, with a raw file for each
+  matrix and a JSON header. If green is True, the surface Green
+  functions of its leads present in the lead cache are also stored"""
+  if ht.dimensionality!=1: raise # only one dimensional
+  if not os.path.isdir(path): os.makedirs(path) # create folder
+  header = {"kind":"heterostructure","attributes":dict(),"matrices":dict()}
+  for name in heterostructure_attributes: # scalar attributes
+    if hasattr(ht,name): header["attributes"][name] = plain(getattr(ht,name))
+  for name in lead_matrices: # leads and couplings
+    header["matrices"][name] = save_array(path,name,getattr(ht,name))
+  hc = ht.central_intra # central part
+  if ht.block_diagonal: # list of lists
+    header["central"] = [[save_array(path,"central_"+str(i)+"_"+str(j),
+        hc[i][j]) for j in range(len(hc))] for i in range(len(hc))]
+  else: header["central"] = save_array(path,"central",hc) # single matrix
+  if hasattr(ht,"central_order"): # ordering of a partition
+    header["matrices"]["central_order"] = save_array(path,"central_order",
+                                                   ht.central_order)
+  if hasattr(ht,"central_geometry"): # geometry of the central part
+    header["geometry"] = save_geometry(path,ht.central_geometry)
+  if green: # surface Green functions of the leads
+    import green as greenlib
+    hashes = [(greenlib.matrix_hash(ht.left_intra),
+               greenlib.matrix_hash(ht.left_inter)),
+              (greenlib.matrix_hash(ht.right_intra),
+               greenlib.matrix_hash(ht.right_inter))]
+    header["green"] = save_green_entries(path,greenlib.lead_cache,hashes)
+  write_header(path,header)
+
+
+
+def load_heterostructure(path,mmap=True,green=True):
+  """Load a heterostructure from a folder. If mmap is True the matrices
+  are memory mapped, and only read from disk when they are used. If
+  green is True, the stored surface Green functions are added to the
+  lead cache"""
+  import heterostructures
+  header = read_header(path,"heterostructure")
+  ht = heterostructures.heterostructure() # empty heterostructure
+  for (name,value) in header["attributes"].items(): setattr(ht,name,value)
+  for (name,entry) in header["matrices"].items():
+    setattr(ht,name,load_array(path,entry,mmap=mmap))
+  if ht.block_diagonal: # list of lists
+    ht.central_intra = [[load_array(path,e,mmap=mmap) for e in row]
+                           for row in header["central"]]
+  else: ht.central_intra = load_array(path,header["central"],mmap=mmap)
+  if "geometry" in header:
+    ht.central_geometry = load_geometry(path,header["geometry"])
+  if ht.has_eh: # function to get the electron and hole sectors
+    from superconductivity import get_eh_sector_odd_even
+    ht.get_eh_sector = get_eh_sector_odd_even
+  if green and "green" in header: # store the Green functions
+    import green as greenlib
+    load_green_entries(path,header["green"],greenlib.lead_cache,mmap=mmap)
+  return ht
+
+
+
+def load_block(path,i,j,mmap=True):
+  """Load a single block of the central part of a stored heterostructure"""
+  header = read_header(path,"heterostructure")
+  return load_array(path,header["central"][i][j],mmap=mmap)
+
+
+
+def save_geometry(path,g):
+  """Save the numerical attributes of a geometry, returns the entry"""
+  out = dict() # dictionary with the attributes
+  for (name,value) in vars(g).items():
+    if isinstance(value,(int,float,bool,str,np.generic)): # scalars
+      out[name] = plain(value) 
+    elif isinstance(value,np.ndarray) or type(value) is list:
+      try: a = np.array(value,dtype=float) # numerical arrays
+      except: continue # not numerical
+      out[name] = save_array(path,"geometry_"+name,a)
+  return out
+
+
+
+def load_geometry(path,entry):
+  """Load a geometry from its entry in the header"""
+  import geometry
+  g = geometry.geometry() # empty geometry
+  for (name,value) in entry.items():
+    if type(value) is dict: value = np.array(load_array(path,value,
+                                                        mmap=False))
+    setattr(g,name,value)
+  return g
+
+
+
+def save_green_entries(path,cache,hashes=None):
+  """Save the surface Green functions of a cache, only for the leads
+  whose hashes are provided if hashes is not None, returns the entries"""
+  groups = dict() # entries for each lead
+  for (key,g) in cache.storage.items():
+    if hashes is not None and tuple(key[0:2]) not in hashes: continue
+    groups.setdefault(tuple(key[0:2]),[]).append((key[2:],g))
+  out = [] # list of entries
+  for (i,(h,items)) in enumerate(groups.items()): # loop over the leads
+    gs = np.array([np.asarray(g) for (k,g) in items]) # all the energies
+    e = save_array(path,"green_"+str(i),gs) # save the stack
+    e["hashes"] = list(h) # hashes of the lead
+    e["keys"] = [list(k) for (k,g) in items] # energy, delta, solver
+    out.append(e) # store
+  return out
+
+
+
+def load_green_entries(path,entries,cache,mmap=True):
+  """Add stored surface Green functions to a cache"""
+  for e in entries:
+    gs = load_array(path,e,mmap=mmap) # stack of Green functions
+    for (k,g) in zip(e["keys"],gs): # loop over energies
+      key = tuple(e["hashes"]) + (float(k[0]),float(k[1]),k[2])
+      cache.store(key,np.matrix(np.array(g))) # copy in memory
+
+
+
+def save_surface_green(path,cache=None):
+  """Save all the surface Green functions of a cache in a folder"""
+  if cache is None: from green import lead_cache as cache
+  if not os.path.isdir(path): os.makedirs(path) # create folder
+  header = {"kind":"surface_green"}
+  header["green"] = save_green_entries(path,cache)
+  write_header(path,header)
+
+
+
+def load_surface_green(path,cache=None,mmap=True):
+  """Add the surface Green functions stored in a folder to a cache"""
+  if cache is None: from green import lead_cache as cache
+  header = read_header(path,"surface_green")
+  load_green_entries(path,header["green"],cache,mmap=mmap)
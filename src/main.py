@@ -31,6 +31,7 @@ from gi.repository import Gtk as gtk
 builder = gtk.Builder()
 
 from qh_interface import * # import all the libraries needed
+import parallel
 
 
 def get(name):
@@ -244,12 +245,15 @@ def run_hamiltonian(self):
   # start the loop over values
   param_ham = np.linspace(get("min_ham"),get("max_ham"),
                             get("step_ham")) # get the energies
-  Gs = [] # empty list
+  hts = [] # empty list
   # now modify that parameter accordingly
   for p in param_ham:
     modify(name,p,active=True) # modify the parameter
-    ht = get_heterostructure() # get the current heterostructure
-    Gs.append(heterostructures.didv(ht,energy = get("energy")))
+    hts.append(get_heterostructure()) # get the current heterostructure
+  energy = get("energy") # energy of the calculation
+  # the list of heterostructures is sent once, tasks only carry an index
+  f = lambda hts,i: heterostructures.didv(hts[i],energy=energy)
+  Gs = parallel.sweep(f,hts,range(len(hts)))
   namef = "TRANSPORT_PARAMETER.OUT" # name of the output file
   inout.write(param_ham,Gs,output_file=namef,comment="xaxis = "+nameaxis)
   plotlandauer(namef)
@@ -272,7 +276,9 @@ def run_energy(self):
   ht = get_heterostructure() # get the current heterostructure
   energies = np.linspace(get("min_energy"),get("max_energy"),
                             get("step_energy")) # get the energies
-  Gs = [heterostructures.didv(ht,energy = e) for e in energies] # get transport
+  # chunks of energies, each one using the multienergy selfenergies
+  f = lambda ht,es: heterostructures.didv(ht,energy=es)
+  Gs = parallel.sweep_chunks(f,ht,energies) # get transport
   name = "LANDAUER_ENERGY.OUT" # name of the output file
   inout.write(energies,Gs,output_file=name,comment="xaxis = Energy")
   plotlandauer(name)
@@ -295,10 +301,17 @@ def run_length(self):
   lengths = range(int(get("min_length")),int(get("max_length")),
                      int(get("step_length"))) # get the energies
   Gs = [] # empty list
-  for l in lengths: # loop over lengths
-    modify("length",l) # modify the length
-    ht = get_heterostructure() # get the current heterostructure
-    Gs.append(heterostructures.didv(ht,energy = get("energy")))
+  if builder.get_object("has_eh").get_active(): # Andreev conductance
+    for l in lengths: # loop over lengths
+      modify("length",l) # modify the length
+      ht = get_heterostructure() # get the current heterostructure
+      Gs.append(heterostructures.didv(ht,energy = get("energy")))
+  else: # single sweep over the lengths
+    def ht_builder(l):
+      modify("length",l) # modify the length
+      return get_heterostructure() # get the current heterostructure
+    Gs = heterostructures.transmission_vs_length(ht_builder,lengths,
+                     energy=get("energy"),delta=0.00001) # same delta as didv
   name = "TRANSPORT_LENGTHS.OUT" # name of the output file
   inout.write(lengths,Gs,output_file=name,comment="xaxis = Central region length")
   plotlandauer(name)
@@ -306,8 +319,29 @@ def run_length(self):
 
 
 
+def get_default(name,default):
+  """Get the value of a variable, or a default if it is not present"""
+  if builder.get_object(name) is None: return default
+  return get(name)
+
+
+
 def run_disorder(self):
+  """Conductance averaged over Anderson disorder realizations"""
+  import disorder_heterostructure
   ht = get_heterostructure() # get the current heterostructure
+  energies = np.linspace(get("min_energy"),get("max_energy"),
+                            get("step_energy")) # get the energies
+  w = get_default("disorder_strength",0.5) # strength of the disorder
+  n = int(get_default("disorder_realizations",100)) # realizations
+  stats = disorder_heterostructure.ensemble(ht,n=n,energies=energies,w=w)
+  name = "LANDAUER_DISORDER.OUT" # name of the output file
+  inout.write(energies,stats.mean,output_file=name,
+                 comment="xaxis = Energy, average over disorder")
+  np.savetxt("DISORDER_STATISTICS.OUT",np.array([energies,stats.mean,
+                np.sqrt(stats.variance())]).T,
+                header="energy, mean and deviation of the conductance")
+  plotlandauer(name)
 
 
 
@@ -336,8 +370,29 @@ def get_adiabatic():
     sm = get_s(hm) # get smatrix
     sp = get_s(hp) # get smatrix
     return (sp-sm)/(2.*eps) # return derivative
-  s1 = get_ds(name1)
-  s2 = get_ds(name2)
+  def get_dh(name):
+    """Derivative of the central Hamiltonian"""
+    modify(name,get(name)-eps,active=True) 
+    htm = get_heterostructure()
+    modify(name,get(name)+2*eps,active=True) 
+    htp = get_heterostructure()
+    modify(name,get(name)-eps,active=True) # original value 
+    hm,hp = htm.central_intra,htp.central_intra # central Hamiltonians
+    if not htp.block_diagonal: # single matrix
+      return (hp-hm)/(2.*eps) 
+    nb = len(hp) # number of blocks
+    dh = [[None for i in range(nb)] for j in range(nb)]
+    for i in range(nb):
+      for j in range(nb):
+        if hp[i][j] is not None: dh[i][j] = (hp[i][j]-hm[i][j])/(2.*eps)
+    return dh
+  if name1.endswith("_C") and name2.endswith("_C"): # only the center changes
+    ht = get_heterostructure()
+    (s1,s2) = heterostructures.get_smatrix_derivative(ht,
+                    [get_dh(name1),get_dh(name2)],energy=energy,as_matrix=True)
+  else: # finite differences of the full S-matrix
+    s1 = get_ds(name1)
+    s2 = get_ds(name2)
   c12 = np.conjugate(s1)*s2.T
   value = np.sum([c12[i,i] for i in range(c12.shape[0]/2)]).imag
   return value # return adiabatic pumping